@@ -0,0 +1,210 @@
+################################################################################
+#
+# MELT Batch Runner
+#
+# Processes many gcode files with the headless runner across a process pool,
+# either a fixed list of files or a spool directory that is watched for new
+# jobs. Files whose header already carries a ;Modified: marker (left by Melt
+# or ColorShift) are skipped.
+#
+# Per-job settings are read from a JSON file next to the job, named like the
+# job with .json in place of .gcode, and override the shared --settings.
+#
+# Usage:
+#   python Batch.py melt jobs/*.gcode --output-dir done --workers 8
+#   python Batch.py melt --watch spool --output-dir done --settings melt.json
+#   python Batch.py miso jobs/*.gcode --output-dir done --report report.json
+#
+################################################################################
+
+import argparse
+import json
+import mmap
+import os
+import signal
+import stat
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import Headless
+
+# Melt stamps ;Modified:, ColorShift writes ;Modified by ColorShift
+MODIFIED_MARKERS = (b';Modified:', b';Modified by')
+
+
+# The header ends at the first ;LAYER:, however long the thumbnails Cura
+# writes into it are, so the file is mapped instead of read
+def is_modified(path):
+    with open(path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        if not size:
+            return False
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = data.find(b';LAYER:')
+            end = size if end < 0 else end
+            return any(data.find(marker, 0, end) >= 0 for marker in MODIFIED_MARKERS)
+
+
+def job_settings(path, settings):
+    sidecar = os.path.splitext(path)[0] + '.json'
+    if not os.path.exists(sidecar):
+        return settings
+    merged = dict(settings)
+    with open(sidecar) as source:
+        merged.update(json.load(source))
+    return merged
+
+
+# Runs one job in a worker, failures are reported instead of raised so one
+# bad file does not stop the batch
+def process_job(transform, source, target, settings):
+    started = time.perf_counter()
+    result = {'input': source, 'output': target, 'bytes': os.path.getsize(source)}
+    try:
+        if is_modified(source):
+            result['status'] = 'skipped'
+        else:
+            Headless.run(transform, source, target, job_settings(source, settings))
+            result['status'] = 'done'
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (type(error).__name__, error)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+# Collects job results and sums them up for the report
+class BatchReport:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.jobs = []
+
+    def add(self, result):
+        self.jobs.append(result)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        done = [job for job in self.jobs if job['status'] == 'done']
+        processed = sum(job['bytes'] for job in done)
+        return {
+            'jobs': len(self.jobs),
+            'done': len(done),
+            'skipped': sum(1 for job in self.jobs if job['status'] == 'skipped'),
+            'failed': sum(1 for job in self.jobs if job['status'] == 'failed'),
+            'seconds': elapsed,
+            'files_per_second': len(done) / elapsed if elapsed else 0,
+            'megabytes_per_second': processed / 1048576 / elapsed if elapsed else 0,
+            'files': self.jobs,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.summary(), output, indent=2)
+
+    def print_job(self, job, output=sys.stdout):
+        line = '%-8s %8.2fs  %s' % (job['status'], job['seconds'], job['input'])
+        if 'error' in job:
+            line += '  (' + job['error'] + ')'
+        print(line, file=output)
+
+    def print(self, output=sys.stdout, jobs=True):
+        summary = self.summary()
+        if jobs:
+            for job in self.jobs:
+                self.print_job(job, output)
+        print('%d jobs: %d done, %d skipped, %d failed in %.1fs (%.2f files/s, %.1f MB/s)' % (
+            summary['jobs'], summary['done'], summary['skipped'], summary['failed'], summary['seconds'],
+            summary['files_per_second'], summary['megabytes_per_second']), file=output)
+
+
+# Ctrl-C is handled by the parent, which lets running jobs finish
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def target_path(source, output_dir):
+    return os.path.join(output_dir, os.path.basename(source))
+
+
+def run_batch(transform, sources, output_dir, settings, workers=None, report=None):
+    report = report or BatchReport()
+    with ProcessPoolExecutor(workers, initializer=ignore_interrupt) as pool:
+        futures = [pool.submit(process_job, transform, source, target_path(source, output_dir), settings)
+                   for source in sources]
+        for future in futures:
+            report.add(future.result())
+    return report
+
+
+# Polls spool for .gcode files, a file is submitted once its size and mtime
+# stop changing between two polls so half-copied jobs are left alone
+def watch(transform, spool, output_dir, settings, workers=None, interval=2.0, report=None):
+    report = report or BatchReport()
+    seen = {}
+    submitted = set()
+    pending = []
+    with ProcessPoolExecutor(workers, initializer=ignore_interrupt) as pool:
+        try:
+            while True:
+                for name in sorted(os.listdir(spool)):
+                    source = os.path.join(spool, name)
+                    if not name.endswith('.gcode'):
+                        continue
+                    try:
+                        status = os.stat(source)
+                    except OSError:  # taken away since the listing
+                        continue
+                    if not stat.S_ISREG(status.st_mode):
+                        continue
+                    stamp = (status.st_size, status.st_mtime)
+                    if (source, stamp) in submitted:
+                        continue
+                    if seen.get(source) == stamp:
+                        submitted.add((source, stamp))
+                        pending.append(pool.submit(process_job, transform, source, target_path(source, output_dir), settings))
+                    seen[source] = stamp
+                for future in [future for future in pending if future.done()]:
+                    pending.remove(future)
+                    report.add(future.result())
+                    report.print_job(report.jobs[-1])
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            for future in pending:
+                report.add(future.result())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process many gcode files with Melt, ColorShift or Miso.')
+    parser.add_argument('transform', choices=sorted(list(Headless.SCRIPTS) + ['miso']))
+    parser.add_argument('inputs', nargs='*', help='gcode files to process')
+    parser.add_argument('--watch', metavar='DIR', help='keep processing new files dropped into DIR')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between polls of the watched folder')
+    parser.add_argument('--output-dir', required=True, help='where processed files are written')
+    parser.add_argument('--workers', type=int, help='number of worker processes, defaults to the CPU count')
+    parser.add_argument('--settings', help='JSON file of settings shared by every job')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a single setting')
+    parser.add_argument('--report', help='write the timings and results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    if not args.inputs and not args.watch:
+        parser.error('give input files or --watch DIR')
+    if args.watch and os.path.abspath(args.watch) == os.path.abspath(args.output_dir):
+        parser.error('--output-dir must differ from the watched folder')
+    os.makedirs(args.output_dir, exist_ok=True)
+    settings = Headless.read_settings(args.settings, args.set)
+
+    if args.watch:
+        report = watch(args.transform, args.watch, args.output_dir, settings, args.workers, args.interval)
+        report.print(jobs=False)  # jobs were printed as they finished
+    else:
+        report = run_batch(args.transform, args.inputs, args.output_dir, settings, args.workers)
+        report.print()
+    if args.report:
+        report.write(args.report)
+    return 1 if report.summary()['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from ..Script import Script
+from .CoreLibrary import EditList, Instrumentation, LayerIndex, MixFormat
 # current problems...
 # running two sets of post processing fails the second post process
 # possibly need an option for shift every 4 layers and shift about 100 times per print to be more clear with choices
@@ -62,20 +63,23 @@ def initiate_extruder(existing_gcode,*ext):
 
 # function to compile extruder info into a string
 def adjust_extruder_rate(existing_gcode, *ext):
-    i = 0
-    for item in ext:
-        if i == 0:
-            setup_line = existing_gcode + " ;Modified: \nM567 P0 E" + str(item)
-        else:
-            setup_line += ":" + str(item) + "\n"
-        i += 1
-    return setup_line
+    return existing_gcode + " ;Modified: \n" + MixFormat.join(ext) + "\n"
+
+# function to turn a compiled string into the lines that replace a marker line
+def split_gcode(gcode):
+    return gcode[:-1].split("\n") if gcode.endswith("\n") else gcode.split("\n")
 
 
 class ColorShift(Script):
     version = "1.0.0"
+
+    # Set to an Instrumentation to time and count the next runs
+    # The last run's report is kept on self.report
+    instrumentation = None
+
     def __init__(self):
         super().__init__()
+        self.report = Instrumentation.disabled()
 
     def getSettingDataString(self):
         return """{
@@ -231,77 +235,82 @@ class ColorShift(Script):
         if layer_end < layer_start:
             layer_start, layer_end = layer_end, layer_start
 
-        # Initialize things that affect decisions
-        current_position = 0
-        index = 0
-
-        # Iterate through the layers
-        for active_layer in data:
+        report = self.report = self.instrumentation or Instrumentation.disabled()
+        report.start()
 
-            # Remove the whitespace and split the gcode into lines
-            lines = active_layer.strip().split("\n")
+        # Find the layers to modify without scanning every line
+        # Changes are recorded and applied to the modified layers at the end
+        with report.phase("parse"):
+            layer_index = LayerIndex(data)
+        if report.enabled:
+            report.count("lines_scanned", sum(chunk.count("\n") + 1 for chunk in data))
+        edits = EditList()
+        layer_count = layer_index.marker("LAYER_COUNT")
+        if layer_count is None:
+            report.stop()
+            return data
 
-            modified_gcode = ""
-            for line in lines:
+        # Find the actual total layers in the gcode
+        total_layers = float(layer_index.layerCount())
 
-                # Find where to add the initial setup info
-                if ";LAYER_COUNT:" in line:
-
-                    # Find the actual total layers in the gcode
-                    total_layers = float(line[(line.index(':') + 1): len(line)])
-
-                    # Calculate positions based on total_layers
-                    if choice == 'percent':
-                        start_position = int(int(total_layers) * float(percent_start))  # find where to start
-                        current_position = start_position
-                        end_position = int(int(total_layers) * float(percent_end))  # find where to end
-                    if choice == 'layer_no':
-                        start_position = int(clamp(layer_start, 0, total_layers))
-                        current_position = start_position
-                        end_position = int(clamp(layer_end, 0, total_layers))
-
-                    # Find the layers that are actually affected or the ones within the clamp set by user
-                    adjusted_layers = end_position - current_position
-
-                    # Make sure that the set adjustments are less then the actual affected layers since you can only adjust once per layer
-                    adjustments = clamp(int(adjustments), 0, adjusted_layers)
+        # Calculate positions based on total_layers
+        if choice == 'percent':
+            start_position = int(int(total_layers) * float(percent_start))  # find where to start
+            end_position = int(int(total_layers) * float(percent_end))  # find where to end
+        else:
+            start_position = int(clamp(layer_start, 0, total_layers))
+            end_position = int(clamp(layer_end, 0, total_layers))
+        current_position = start_position
 
-                    # Find how often to adjust the rate
-                    change_rate = int(int(adjusted_layers) / int(adjustments))
+        # Find the layers that are actually affected or the ones within the clamp set by user
+        adjusted_layers = end_position - current_position
 
-                    # Math to determine extruder percentage based on layer location without flow clamp and adjustments
-                    location = (current_position-start_position)/(adjusted_layers-change_rate)
+        # Make sure that the set adjustments are less then the actual affected layers since you can only adjust once per layer
+        adjustments = clamp(int(adjustments), 0, adjusted_layers)
 
-                    # Adjust extruder percentages by user set flow and clamp adjustments
-                    extruder_one = format(location * flow_one_adjust * flow_clamp_adjust + flow_min, '.3f')
-                    extruder_two = format((1-location) * flow_two_adjust * flow_clamp_adjust + flow_min, '.3f')
+        # Find how often to adjust the rate
+        change_rate = int(int(adjusted_layers) / int(adjustments))
 
-                    # Send extruder percentages to be compiled into a string based on direction set by user
-                    if direction == 'normal':
-                        modified_gcode = initiate_extruder(line, extruder_one, extruder_two)
-                    else:
-                        modified_gcode = initiate_extruder(line, extruder_two, extruder_one)
+        # Math to determine extruder percentage based on layer location without flow clamp and adjustments
+        location = (current_position-start_position)/(adjusted_layers-change_rate)
 
-                # Find where to add for affected layers
-                elif ";LAYER:" + str(current_position) in line and int(current_position) < int(end_position):
+        # Adjust extruder percentages by user set flow and clamp adjustments
+        extruder_one, extruder_two = MixFormat.ratios((location * flow_one_adjust * flow_clamp_adjust + flow_min,
+                                                       (1-location) * flow_two_adjust * flow_clamp_adjust + flow_min))
 
-                    # Same thing we did above
-                    location = (current_position-start_position)/(adjusted_layers-change_rate)
-                    extruder_one = format(location*flow_one_adjust * flow_clamp_adjust + flow_min, '.3f')
-                    extruder_two = format((1-location)*flow_two_adjust * flow_clamp_adjust + flow_min, '.3f')
-                    if direction == 'normal':
-                        modified_gcode = adjust_extruder_rate(line, extruder_one, extruder_two)
-                    else:
-                        modified_gcode = adjust_extruder_rate(line, extruder_two, extruder_one)
+        # Send extruder percentages to be compiled into a string based on direction set by user
+        line = layer_count[2] and ";LAYER_COUNT:" + layer_count[2] or ";LAYER_COUNT:"
+        if direction == 'normal':
+            edits.replace(layer_count[:2], split_gcode(initiate_extruder(line, extruder_one, extruder_two)))
+        else:
+            edits.replace(layer_count[:2], split_gcode(initiate_extruder(line, extruder_two, extruder_one)))
+        report.count("m567_emitted")
 
-                    # Increase the position for the next line to find it on the next loop
-                    current_position += int(change_rate)
+        # Find where to add for affected layers
+        while change_rate > 0 and current_position < end_position:
+            layer_position = layer_index.layer(current_position)
+            if layer_position is not None:
 
-                # If no conditions apply leave the code alone
+                # Same thing we did above
+                location = (current_position-start_position)/(adjusted_layers-change_rate)
+                extruder_one, extruder_two = MixFormat.ratios((location*flow_one_adjust * flow_clamp_adjust + flow_min,
+                                                               (1-location)*flow_two_adjust * flow_clamp_adjust + flow_min))
+                line = ";LAYER:" + str(current_position)
+                if direction == 'normal':
+                    edits.replace(layer_position, split_gcode(adjust_extruder_rate(line, extruder_one, extruder_two)))
                 else:
-                    modified_gcode += line + "\n"
+                    edits.replace(layer_position, split_gcode(adjust_extruder_rate(line, extruder_two, extruder_one)))
+                report.count("m567_emitted")
+                report.count("layers_modified")
+
+            # Increase the position for the next line to find it on the next loop
+            current_position += int(change_rate)
 
-            # Replace the data
-            data[index] = modified_gcode
-            index += 1
+        # Only the layers that changed are split and joined again
+        with report.phase("emit"):
+            data = edits.apply(data)
+        report.set("version", self.version)
+        report.set("total_layers", int(total_layers))
+        report.set("change_rate", change_rate)
+        report.stop()
         return data
@@ -18,22 +18,80 @@
 #       tool = Miso.Tool([gradientStart, gradientStop])
 #       Miso.setToolConfig(2, tool) # sets this gradient for tool 2
 #
+#   Sizing the mix cache:
+#       Miso.setMixCache(size=8192, quantum=0.0001)
+#       Miso.mixCache().stats() # hits, misses, entries
+#
+#   Bounding mix error instead of following every z change (vase mode):
+#       Miso.setMixCache(tolerance=0.01) # ratios stay within 0.01 of the gradient
+#
 #   Converting gcode:
 #       maxZHeight = maxHeightOfPrint
 #       newcode = Miso.fromGcode(gcode, maxZHeight)
 #
+#   Streaming gcode (bounded memory):
+#       with open(path) as source, open(target, 'w') as output:
+#           for chunk in Miso.streamGcode(source, maxZHeight):
+#               output.write(chunk)
+#
+#   Streaming Cura's per-layer data list:
+#       chunks = Miso.streamGcode(Miso.iterLines(data), maxZHeight)
+#
+#   Converting across CPU cores (same output as fromGcode):
+#       newcode = Miso.fromGcodeParallel(lines, maxZHeight, workers=16)
+#
+#   Converting with column passes over a MoveTable (needs numpy):
+#       newcode = Miso.fromTable(lines, maxZHeight)
+#
+#   Compensating a mixing chamber (needs fromTable):
+#       Miso.setMixingVolume(30.0, diameter=1.75) # mm3, mixes are written that much extrusion early
+#
+#   Configuring a side to side or corner to corner gradient (needs fromTable):
+#       tool = Miso.Tool([gradientStart, gradientStop], axis=(1, 1, 0))
+#       Miso.setToolConfig(3, tool) # stops run from the -X -Y to the +X +Y corner
+#
 ################################################################################
 
+import heapq
+import json
+import math
+import os
 import re
+import time
+import tracemalloc
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:  # only MoveTable needs it
+    numpy = None
 
 class Miso:
     # Hash of ToolConfigurations
     # Allows extruder mixes to be assigned to different tools
     _toolConfigs = {}
 
+    # Formatted mixes shared by every conversion, see Miso.MixCache
+    _mixCache = None
+
+    # Filament held in the mixing chamber, mm of filament
+    _mixingLength = 0.0
+
+    # Back to no tools, the default mix cache and no mixing chamber, for
+    # callers that convert several files in one process
+    @staticmethod
+    def reset():
+        Miso._toolConfigs = {}
+        Miso._mixCache = None
+        Miso._mixingLength = 0.0
+
     @staticmethod
     def setToolConfig(toolId, toolConfig):
         Miso._toolConfigs[toolId] = toolConfig
+        Miso.mixCache().invalidate(toolId)
 
     @staticmethod
     def getToolConfig(toolId):
@@ -41,42 +99,395 @@ class Miso:
             return Miso._toolConfigs[toolId]
         return Miso.Tool() #default
 
+    @staticmethod
+    def mixCache():
+        if Miso._mixCache is None:
+            Miso._mixCache = Miso.MixCache()
+        return Miso._mixCache
+
+    # Replaces the mix cache, size is the number of formatted mixes kept and
+    # quantum the z fraction resolution used to build keys
+    # tolerance is the largest ratio error allowed, see Miso.MixCache
+    @staticmethod
+    def setMixCache(size=4096, quantum=0.0001, tolerance=0):
+        Miso._mixCache = Miso.MixCache(size, quantum, tolerance)
+
+    # A mix only reaches the nozzle once the chamber's volume (mm3) has been
+    # pushed out, fromTable writes mixes that much extrusion early
+    @staticmethod
+    def setMixingVolume(volume, diameter=1.75):
+        Miso._mixingLength = ExtrusionIndex.length(volume, diameter)
+
+    # Spatial tools and mixing compensation need the whole file up front
+    @staticmethod
+    def needsTable():
+        return bool(Miso.spatialTools()) or Miso._mixingLength > 0
+
     # Forward-reading modification of gcode here
     # tracks tool changes, z changes, and relative / absolute changes
     # When an extrusion command is found and any of this info has changed
     # then a new mix command is written
     @staticmethod
     def fromGcode(gcode, zmax):
-        tool = 0
-        toolHistory = tool
-        zpos = 0
-        zposHistory = zpos
-        relative = False
-        relativeHistory = relative
-        newcode = ''
+        return ''.join(Miso.streamGcode(gcode, zmax))
+
+    # Generator version of fromGcode
+    # Accepts any iterable of lines (list, open file, generator) and yields the
+    # converted gcode in chunks of about chunkSize lines so memory stays bounded
+    # state and history let a conversion continue from the middle of a file,
+    # history being the (tool, z, relative) of the last mix decision
+    # A mix identical to the last one written for its tool is left out, mixes
+    # holds those last mixes by tool and is updated as the conversion goes
+    # A tool change (T<n>) or a tool redefined by M563 P<n> forgets the
+    # tool's last mix, its next mix is written even when it repeats it
+    # firsts, when given, collects the (offset, mix) of the first mix written
+    # for each tool not in mixes, offset counting characters of the output
+    @staticmethod
+    def streamGcode(gcode, zmax, chunkSize=4096, state=None, history=None, mixes=None, firsts=None):
+        if Miso.needsTable():
+            raise ValueError('Tools with a gradient axis and mixing compensation need Miso.fromTable')
+        parse = Miso.Lexer.parse
+        state = state or Miso.State()
+        update = state.update
+        seen = None if history is not None and history != state.snapshot() else state.changes
+        history = history or state.snapshot()
+        mixes = {} if mixes is None else mixes
+        written = 0
+        buffer = []
         for line in gcode:
-            tool = Miso.Gcode.updateTool(line, tool)
-            zpos = Miso.Gcode.updateZ(line, zpos, relative)
-            relative = Miso.Gcode.updateRelative(line, relative)
-            isDirty = tool != toolHistory or zpos != zposHistory or relative != relativeHistory
-            if isDirty and Miso.Gcode.isExtrude(line):
-                toolHistory = tool
-                zposHistory = zpos
-                relativeHistory = relative
-                newcode += Miso.Gcode.formatMix(tool, zpos, zmax) + "\n"
-            newcode += line + '\n'
-        return newcode
+            line = line.rstrip('\r\n')
+            command = parse(line)
+            if command is None:
+                pass
+            elif update(command):
+                if state.changes != seen:
+                    seen = state.changes
+                    current = state.snapshot()
+                    if current != history:
+                        history = current
+                        mix = Miso.Gcode.formatMix(state.tool, state.zpos, zmax)
+                        if mixes.get(state.tool) != mix:
+                            if firsts is not None and state.tool not in mixes:
+                                firsts[state.tool] = (written + sum(map(len, buffer)), mix)
+                            mixes[state.tool] = mix
+                            buffer.append(mix + '\n')
+            elif command.code == 'M567':  # a mix already in the gcode
+                tool = command.value('P')
+                mixes[0 if tool is None else int(tool)] = command.body
+            elif command.code[0] == 'T' or command.code == 'M563':
+                tool = Miso._forgets(command)
+                if tool is not None:
+                    mixes[tool] = None  # kept as a key so the tool is not in firsts
+            buffer.append(line + '\n')
+            if len(buffer) >= chunkSize:
+                output = ''.join(buffer)
+                written += len(output)
+                yield output
+                buffer = []
+        if buffer:
+            yield ''.join(buffer)
+
+    # Version of fromGcode that tracks the state with column passes over a
+    # MoveTable, only the extrusions where the state changes and the mixes
+    # already in the gcode are visited one at a time
+    # Same output as fromGcode, except that G92 Z is followed
+    # Tools with a gradient axis and mixing compensation are only supported
+    # here, see _spatialIndexes and _compensate
+    @staticmethod
+    def fromTable(gcode, zmax):
+        return ''.join(Miso.streamTable(gcode, zmax))
+
+    # Generator version of fromTable, the whole input is parsed first
+    @staticmethod
+    def streamTable(gcode, zmax, chunkSize=4096):
+        lines = gcode if isinstance(gcode, list) else list(gcode)
+        table = MoveTable(lines)
+        rows = table.rows
+        changes = table.extrusionChanges()
+        spatial = Miso.spatialTools()
+        indexes = None
+        if spatial:
+            indexes, moved = Miso._spatialIndexes(table, spatial)
+            changes |= moved
+        codes = rows['code']
+        forgets = numpy.char.startswith(codes, b'T') | (codes == b'M563')
+        visits = numpy.flatnonzero(changes | (codes == b'M567') | forgets)
+        tools = rows['tool']
+        heights = table.position('Z')
+        offsets = rows['line']
+        mixes = {}
+        inserts = []
+        written = []
+        for row in visits.tolist():
+            if changes[row]:
+                tool = int(tools[row])
+                if indexes is not None and tool in spatial:
+                    mix = Miso.Gcode.formatMix(tool, float(indexes[row]), 1.0)
+                else:
+                    mix = Miso.Gcode.formatMix(tool, float(heights[row]), zmax)
+                if mixes.get(tool) != mix:
+                    mixes[tool] = mix
+                    inserts.append(mix)
+                    written.append(row)
+            elif forgets[row]:
+                tool = Miso._forgets(Miso.Lexer.parse(lines[offsets[row]].rstrip('\r\n')))
+                if tool is not None:
+                    mixes[tool] = None
+            else:  # a mix already in the gcode
+                command = Miso.Lexer.parse(lines[offsets[row]].rstrip('\r\n'))
+                tool = command.value('P')
+                mixes[0 if tool is None else int(tool)] = command.body
+        written = numpy.asarray(written, dtype=numpy.int64)
+        if Miso._mixingLength > 0 and len(written):
+            written = Miso._compensate(table, written, Miso._mixingLength)
+        return MoveTable.splice(lines, zip(offsets[written].tolist(), inserts), chunkSize)
+
+    # Moves each mix from the front of its row to where length mm of
+    # filament are still to be extruded before that row, found with a binary
+    # search over the running extrusion total
+    # A mix never moves before the tool change that selected its tool, the
+    # chamber only starts on the new mix once that tool is extruding
+    @staticmethod
+    def _compensate(table, rows, length):
+        extruded = table.extruded()
+        before = numpy.where(rows > 0, extruded[numpy.maximum(rows - 1, 0)], 0.0)
+        earliest = numpy.searchsorted(extruded, before - length, side='right')
+        changes = MoveTable._lastIndex(numpy.char.startswith(table.rows['code'], b'T'))[rows] + 1
+        return numpy.minimum(numpy.maximum(earliest, changes), rows)
+
+    # Tool whose last written mix a command makes unknown, the tool selected
+    # by T<n> or redefined by M563 P<n>, None for anything else
+    @staticmethod
+    def _forgets(command):
+        code = command.code
+        if code == 'M563':
+            tool = command.value('P')
+            return None if tool is None else int(tool)
+        if code[1:].isdigit():
+            return int(code[1:])
+        return None
+
+    # Ids of the configured tools that have a gradient axis
+    @staticmethod
+    def spatialTools():
+        return {tool for tool, config in Miso._toolConfigs.items() if config.axis is not None}
+
+    # Gradient index of every extrusion by a spatial tool (NaN for other rows)
+    # and a mask of the extrusions whose quantized index or tool differs from
+    # the extrusion before
+    # Each move is placed at its middle, scaled to 0..1 over the bounding box
+    # of the extrusions in the layers (the start gcode's purge line is left
+    # out) and projected on the tool's axis, so the index runs from 0 at one
+    # corner of the box to 1 at the opposite one
+    @staticmethod
+    def _spatialIndexes(table, spatial):
+        rows = table.rows
+        extrusions = numpy.flatnonzero(table.extrusions())
+        points = numpy.stack([table.position(axis) for axis in 'XYZ'], axis=1)
+        ends = points[extrusions]
+        middles = (points[numpy.maximum(extrusions - 1, 0)] + ends) / 2
+        printed = rows['layer'][extrusions] >= 0
+        box = ends[printed] if printed.any() else ends
+        low = box.min(axis=0) if len(box) else numpy.zeros(3)
+        size = box.max(axis=0) - low if len(box) else numpy.ones(3)
+        size[size == 0] = 1
+        unit = (middles - low) / size
+        tools = rows['tool'][extrusions]
+        indexes = numpy.full(len(rows), numpy.nan)
+        keys = numpy.zeros(len(extrusions), dtype=numpy.int64)
+        cache = Miso.mixCache()
+        for tool in spatial:
+            mask = tools == tool
+            axis = numpy.asarray(Miso.getToolConfig(tool).axis, dtype=float)
+            start = numpy.minimum(axis, 0).sum()
+            span = numpy.maximum(axis, 0).sum() - start
+            index = (unit[mask] @ axis - start) / span if span else numpy.zeros(mask.sum())
+            indexes[extrusions[mask]] = index
+            keys[mask] = numpy.rint(index / (cache.quanta.get(tool) or cache.toolQuantum(tool)))
+        changed = numpy.isin(tools, list(spatial))
+        changed[1:] &= (keys[1:] != keys[:-1]) | (tools[1:] != tools[:-1])
+        moved = numpy.zeros(len(rows), dtype=bool)
+        moved[extrusions[changed]] = True
+        return indexes, moved
+
+    # Two phase parallel version of fromGcode for a list of lines
+    # The prescan works out the state at the start of every chunk, then the
+    # chunks are converted independently in a process pool and joined in order
+    # context is the multiprocessing context of the pool, the default one when
+    # None. Spawned workers import this module by name, so it has to be
+    # importable as it is named here (see Headless.load_miso)
+    @staticmethod
+    def fromGcodeParallel(gcode, zmax, workers=None, chunkSize=200000, context=None):
+        return ''.join(Miso.streamGcodeParallel(gcode, zmax, workers, chunkSize, context))
+
+    # Yields the converted chunks of fromGcodeParallel in order
+    # Workers cannot know the mixes written before their chunk, so the first
+    # mix of each tool in a chunk is dropped here when it repeats the last one
+    # Only two chunks per worker are handed to the pool at a time, so a long
+    # file is not copied into the pool's queue all at once
+    @staticmethod
+    def streamGcodeParallel(gcode, zmax, workers=None, chunkSize=200000, context=None):
+        if Miso.needsTable():
+            raise ValueError('Tools with a gradient axis and mixing compensation need Miso.fromTable')
+        boundaries = Miso.prescan(gcode, chunkSize)
+        jobs = ((gcode[start:start + chunkSize], zmax, state, history)
+                for start, (state, history) in zip(range(0, len(gcode), chunkSize), boundaries))
+        cache = Miso.mixCache()
+        setup = (Miso._toolConfigs, cache.size, cache.quantum, cache.tolerance)
+        window = 2 * (workers or os.cpu_count() or 1)
+        mixes = {}
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=Miso._setupWorker, initargs=setup) as pool:
+            for chunk, firsts, last in Miso._inOrder(pool, jobs, window):
+                repeats = sorted(offset for tool, (offset, mix) in firsts.items() if mixes.get(tool) == mix)
+                for offset in reversed(repeats):
+                    chunk = chunk[:offset] + chunk[chunk.index('\n', offset) + 1:]
+                mixes.update(last)
+                yield chunk
+
+    # Results of the jobs in order, keeping at most window of them in the pool
+    @staticmethod
+    def _inOrder(pool, jobs, window):
+        pending = deque()
+        for job in jobs:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(pool.submit(Miso._convertChunk, job))
+        while pending:
+            yield pending.popleft().result()
+
+    # Lines that might change the state, everything else is skipped by the
+    # prescan: tool changes, G90 / G91 and anything with a Z word, spaced or
+    # compact (G1Z0.4)
+    _stateLines = re.compile('\n[ \t]*(?:[Tt]|[Gg]0*9)')
+    _zWords = re.compile('[ \t0-9.][Zz]')
+
+    # (state, history) at the start of every chunkSize lines of gcode
+    # Only the lines found by _stateLines / _zWords and the last extrusion move
+    # of each chunk are parsed, history being the state after that move
+    @staticmethod
+    def prescan(gcode, chunkSize):
+        state = Miso.State()
+        history = state.snapshot()
+        boundaries = []
+        for start in range(0, len(gcode), chunkSize):
+            boundaries.append((Miso.State(*state.snapshot()), history))
+            chunk = [line.rstrip('\r\n') for line in gcode[start:start + chunkSize]]
+            lastExtrude = None
+            for line in range(len(chunk) - 1, -1, -1):
+                command = Miso.Lexer.parse(chunk[line])
+                if command is not None and Miso.State().update(command):
+                    lastExtrude = line
+                    break
+            text = '\n' + '\n'.join(chunk)
+            offsets = heapq.merge((match.start() + 1 for match in Miso._stateLines.finditer(text)),
+                                  (match.start() for match in Miso._zWords.finditer(text)))
+            line = -1
+            previous = 0
+            parsed = -1
+            for offset in offsets:
+                line += text.count('\n', previous, offset)
+                previous = offset
+                if line == parsed:
+                    continue
+                parsed = line
+                if lastExtrude is not None and line > lastExtrude:
+                    history = state.snapshot()
+                    lastExtrude = None
+                command = Miso.Lexer.parse(chunk[line])
+                if command is not None:
+                    state.update(command)
+            if lastExtrude is not None:
+                history = state.snapshot()
+        return boundaries
+
+    @staticmethod
+    def _setupWorker(toolConfigs, cacheSize, quantum, tolerance):
+        Miso._toolConfigs = toolConfigs
+        Miso.setMixCache(cacheSize, quantum, tolerance)
+
+    # Converted chunk with its first and last mix of each tool
+    @staticmethod
+    def _convertChunk(job):
+        lines, zmax, state, history = job
+        mixes = {}
+        firsts = {}
+        chunk = ''.join(Miso.streamGcode(lines, zmax, state=state, history=history, mixes=mixes, firsts=firsts))
+        return chunk, firsts, mixes
+
+    # Splits Cura's per-layer data list (or any iterable of multi-line
+    # strings) into single lines for streamGcode
+    @staticmethod
+    def iterLines(chunks):
+        for chunk in chunks:
+            for line in chunk.splitlines():
+                yield line
 
     # Miso.Tool
     # Mix and gradient information for a specific tool
     # Example:
     #   toolConfig = Miso.Tool([mix1, mix2, ...])
+    # Stops are also kept as a sorted table so the segment around a height
+    # is found with a binary search:
+    #   zstops  -> array of stop heights in ascending order
+    #   values  -> flat array of the stop mixes, width values per stop
+    # axis turns the stops into a spatial gradient: an (x, y, z) direction
+    # across the print's bounding box, (1, 0, 0) for side to side or
+    # (1, 1, 1) for bottom corner to opposing top corner, zstop then being
+    # the fraction of the way along it (see Miso.fromTable)
     class Tool:
-        def __init__(self, stops=None):
+        def __init__(self, stops=None, axis=None):
             stops = stops or [Miso.Mix()]
+            self.axis = tuple(axis) if axis is not None else None
             self.stops = {}
             for stop in stops:
                 self.stops[stop.zstop] = stop.mix
+            self.zstops = array('d', sorted(self.stops))
+            self.width = max(len(mix) for mix in self.stops.values())
+            self.values = array('d')
+            for zstop in self.zstops:
+                mix = self.stops[zstop]
+                self.values.extend(mix)
+                self.values.extend([0] * (self.width - len(mix)))
+
+        # Indexes of the stops below and above index (a z fraction)
+        # Both are the same stop when index is on or outside a stop
+        def segment(self, index):
+            zstops = self.zstops
+            position = bisect_right(zstops, index)
+            if position == 0:
+                return 0, 0
+            if position == len(zstops) or zstops[position - 1] == index:
+                return position - 1, position - 1
+            return position - 1, position
+
+        # Interpolated mix at index (a z fraction)
+        def mixAt(self, index):
+            start, end = self.segment(index)
+            width = self.width
+            values = self.values
+            if start == end:
+                return list(values[start * width:(start + 1) * width])
+            low = self.zstops[start]
+            fraction = (index - low) / (self.zstops[end] - low)
+            mix = []
+            for extruder in range(width):
+                svalue = values[start * width + extruder]
+                evalue = values[end * width + extruder]
+                mix.append((evalue - svalue) * fraction + svalue)
+            return mix
+
+        # Steepest change of any extruder ratio per unit of z fraction
+        def slope(self):
+            width = self.width
+            values = self.values
+            zstops = self.zstops
+            steepest = 0.0
+            for stop in range(1, len(zstops)):
+                span = zstops[stop] - zstops[stop - 1]
+                for extruder in range(width):
+                    change = abs(values[stop * width + extruder] - values[(stop - 1) * width + extruder])
+                    steepest = max(steepest, change / span)
+            return steepest
 
     # Miso.Mix
     # Mix information for a single stop (layer)
@@ -87,91 +498,1157 @@ class Miso:
             self.mix = mix
             self.zstop = zstop
 
+    # Miso.MixCache
+    # Bounded LRU cache of formatted M567 commands
+    # Keyed by tool id and the z fraction rounded to quantum, so tools that
+    # swap every layer reuse their mixes instead of recomputing them
+    # With a tolerance each tool's quantum is widened to the largest step
+    # whose rounding keeps every ratio within tolerance of the gradient
+    # (2 * tolerance / slope), so a vase print that changes Z on every move
+    # only writes a mix when the rounded mix actually changes
+    class MixCache:
+        def __init__(self, size=4096, quantum=0.0001, tolerance=0):
+            self.size = size
+            self.quantum = quantum
+            self.tolerance = tolerance
+            self.quanta = {}
+            self.entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+        def key(self, tool, index):
+            return (tool, int(round(index / (self.quanta.get(tool) or self.toolQuantum(tool)))))
+
+        # z fraction step used for the keys of a tool
+        def toolQuantum(self, tool):
+            quantum = self.quantum
+            if self.tolerance > 0:
+                slope = Miso.getToolConfig(tool).slope()
+                if slope > 0:
+                    quantum = max(quantum, 2 * self.tolerance / slope)
+            self.quanta[tool] = quantum
+            return quantum
+
+        # z fraction a key stands for
+        def index(self, key):
+            return key[1] * (self.quanta.get(key[0]) or self.toolQuantum(key[0]))
+
+        def get(self, key):
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+        def put(self, key, value):
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        # Drops the entries of a single tool, or all of them
+        def invalidate(self, tool=None):
+            if tool is None:
+                self.entries.clear()
+                self.quanta.clear()
+                return
+            self.quanta.pop(tool, None)
+            for key in [key for key in self.entries if key[0] == tool]:
+                del self.entries[key]
+
+        def stats(self):
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
+    # Miso.Command
+    # A single parsed line of gcode
+    # code is the leading command word (G1, T0, M567, ...)
+    # body is the upper cased line without its comment
+    # params maps X/Y/Z/E/F/T/P to their numeric values, it is only built
+    # when asked for since the state trackers read the body directly
+    class Command:
+        __slots__ = ('code', 'body', '_params')
+        _keys = frozenset('XYZEFTP')
+
+        def __init__(self, code, body):
+            self.code = code
+            self.body = body
+            self._params = None
+
+        @property
+        def params(self):
+            if self._params is None:
+                params = {}
+                for word in self.body.split()[1:]:
+                    if word[0] in Miso.Command._keys:
+                        try:
+                            params[word[0]] = float(word[1:])
+                        except ValueError:
+                            pass
+                self._params = params
+            return self._params
+
+        # Numeric value of a single parameter, or None when it is missing
+        def value(self, key):
+            body = self.body
+            start = body.find(' ' + key)
+            if start < 0:
+                return None
+            start += 2
+            end = body.find(' ', start)
+            try:
+                return float(body[start:end] if end >= 0 else body[start:])
+            except ValueError:
+                return None
+
+    # Miso.Lexer
+    # Single pass tokenizer, splits off the comment and reads the command
+    # word once so callers can dispatch on it without any regex scans
+    # Example:
+    #   command = Miso.Lexer.parse('G1 X10 Z0.4 E1.5 ;perimeter')
+    #   command.code   -> 'G1'
+    #   command.params -> {'X': 10.0, 'Z': 0.4, 'E': 1.5}
+    # Compact gcode without spaces (G1X10Z0.4E1.5) reads the same
+    class Lexer:
+        _gaps = re.compile('(?<=[0-9.])(?=[A-Z])')
+
+        @staticmethod
+        def parse(line):
+            if not line or line[0] == ';':
+                return None
+            end = line.find(';')
+            if end >= 0:
+                line = line[:end]
+            body = line.strip().upper()
+            if not body:
+                return None
+            end = body.find(' ')
+            code = body[:end] if end >= 0 else body
+            if not code[1:].isdigit():  # G1X10Y5E0.4, split before every letter
+                body = Miso.Lexer._gaps.sub(' ', body)
+                end = body.find(' ')
+                code = body[:end] if end >= 0 else body
+            if len(code) > 2 and code[1] == '0' and code[1:].isdigit():
+                code = code[0] + str(int(code[1:]))  # G01 -> G1
+            return Miso.Command(code, body)
+
+    # Miso.State
+    # Tool, height and positioning mode tracked while reading gcode
+    # update() feeds every tracker from one parsed command and returns True
+    # when the command is an extrusion move
+    # changes counts updates that touched the state so readers can skip
+    # comparing snapshots when nothing happened
+    class State:
+        _moves = frozenset(('G0', 'G1', 'G2', 'G3'))
+
+        def __init__(self, tool=0, zpos=0, relative=False):
+            self.tool = tool
+            self.zpos = zpos
+            self.relative = relative
+            self.changes = 0
+
+        def snapshot(self):
+            return (self.tool, self.zpos, self.relative)
+
+        def update(self, command):
+            code = command.code
+            if code in Miso.State._moves:
+                if ' Z' in command.body:
+                    value = command.value('Z')
+                    if value is not None:
+                        self.zpos = self.zpos + value if self.relative else value
+                        self.changes += 1
+                return ' E' in command.body
+            if code[0] == 'T' and code[1:].isdigit():
+                self.tool = int(code[1:])
+            elif code == 'G90':
+                self.relative = False
+            elif code == 'G91':
+                self.relative = True
+            else:
+                return False
+            self.changes += 1
+            return False
+
     # Miso.Gcode
     # Methods that help read and generate gcode
     class Gcode:
-        _movecodes = re.compile('^\\s*(G0|G1).+Z(?P<distance>\\d+)\\b')
-        _extrudecodes = re.compile('^\\s*(G0|G1|G2|G3).+(E|F)\\d+\\b')
-        _toolcodes = re.compile('^\\s*T(?P<toolid>\\d+)\\b')
-        _absolutecodes = re.compile('^\\s*G91\\b')
-        _relativecodes = re.compile('^\\s*G90\\b')
-
         @staticmethod
         def updateRelative(line, current):
-            if Miso.Gcode._relativecodes.match(line):
-                return True
-            if Miso.Gcode._absolutecodes.match(line):
-                return False
-            return current
+            state = Miso.State(relative=current)
+            command = Miso.Lexer.parse(line)
+            if command is not None:
+                state.update(command)
+            return state.relative
 
         @staticmethod
         def updateTool(line, current):
-            match = Miso.Gcode._toolcodes.search(line)
-            if match:
-                return int(match.group('toolid'))
-            return current
+            state = Miso.State(tool=current)
+            command = Miso.Lexer.parse(line)
+            if command is not None:
+                state.update(command)
+            return state.tool
 
         @staticmethod
         def updateZ(line, current, relative):
-            match = Miso.Gcode._movecodes.search(line)
-            if match and relative:
-                change = float(match.group('distance'))
-                return current + change
-            if match:
-                return float(match.group('distance'))
-            return current
+            state = Miso.State(zpos=current, relative=relative)
+            command = Miso.Lexer.parse(line)
+            if command is not None:
+                state.update(command)
+            return state.zpos
 
         @staticmethod
         def isExtrude(line):
-            return Miso.Gcode._extrudecodes.match(line)
+            command = Miso.Lexer.parse(line)
+            return command is not None and Miso.State().update(command)
 
+        # The mix is evaluated at the quantized height of its cache key so the
+        # output does not depend on what is already cached
         @staticmethod
         def formatMix(tool, zpos, zmax):
-            index = zpos / zmax
-            mix = Miso.Gcode._calcMix(index, tool)
-            for i in range(len(mix)):
-                mix[i] = Miso.Gcode._formatNumber(mix[i])
-            return 'M567 P' + str(tool) + ' E' + ':'.join(mix)
+            cache = Miso.mixCache()
+            key = cache.key(tool, zpos / zmax)
+            command = cache.get(key)
+            if command is None:
+                command = MixFormat.command(Miso.Gcode._calcMix(cache.index(key), tool), tool)
+                cache.put(key, command)
+            return command
 
         @staticmethod
         def _calcMix(index, tool):
-            segment = Miso.Gcode._calcSegment(index, tool)
-            srange = segment.keys()
-            if len(srange) == 0:
-                return [1]
-            if len(srange) == 1:
-                return segment[srange[0]]
-            index = (index - min(srange[0], srange[1])) / (max(srange[0], srange[1])-min(srange[0], srange[1]))
-            mix = []
-            start = segment[min(srange[0], srange[1])]
-            end = segment[max(srange[0], srange[1])]
-            for extruder in range(max(len(start), len(end))):
-                svalue = len(start) < extruder and start[extruder] or 0
-                evalue = len(end) < extruder and end[extruder] or 0
-                mix.append((evalue - svalue) * index + svalue)
-            return mix
+            return Miso.getToolConfig(tool).mixAt(index)
 
         @staticmethod
         def _calcSegment(index, tool):  # NOTE: this will allow mixes that total more than 1
-            stops = Miso.getToolConfig(tool).stops
-            start = None
-            end = None
-            for stop in stops.keys():  # TODO: If stop is 0 there will be a bug
-                start = stop <= index and (start != None and max(start, stop) or stop) or start
-                end = stop >= index and (end != None and max(end, stop) or stop) or end
+            toolConfig = Miso.getToolConfig(tool)
             segment = {}
-            if start:
-                segment[start] = stops[start]
-            if end:
-                segment[end] = stops[end]
+            for stop in set(toolConfig.segment(index)):
+                zstop = toolConfig.zstops[stop]
+                segment[zstop] = toolConfig.stops[zstop]
             return segment
 
-        @staticmethod
-        def _formatNumber(value):
-            value = str(value).strip()
-            if re.match('^\\.', value):
-                value = '0' + value
-            filter = re.search('\\d+(\\.\\d{1,2})?', value)
-            if not filter:
-                return '0'
-            return filter.string[filter.start():filter.end()]
+
+################################################################################
+#
+# MixFormat
+#
+# Formats mix ratios and M567 lines for Melt, ColorShift and Miso.
+#
+# The 1001 strings '0.000' to '1.000' are built once and looked up instead of
+# formatted, giving the same text as format(value, '.3f') (except -0.0, which
+# gives '0.000'). Values outside 0..1 (flow adjusted mixes can pass 1) and
+# values too close to halfway between two table entries to round safely fall
+# back to format(). The lookup is inlined in ratios() since a function call
+# per value costs more than the formatting it saves. NaN and infinite values
+# raise a ValueError, they would write an M567 the firmware cannot read.
+#
+# Usage:
+#   MixFormat.ratio(0.25)                  # '0.250'
+#   MixFormat.ratios([0.25, 0.75])         # ['0.250', '0.750']
+#   MixFormat.command([0.25, 0.75], 1)     # 'M567 P1 E0.250:0.750'
+#   MixFormat.join(['0.250', '0.750'])     # 'M567 P0 E0.250:0.750'
+#
+################################################################################
+
+class MixFormat:
+    table = tuple(format(step / 1000, '.3f') for step in range(1001))
+    _prefixes = {}
+
+    @staticmethod
+    def ratio(value):
+        return MixFormat.ratios((value,))[0]
+
+    @staticmethod
+    def ratios(values):
+        table = MixFormat.table
+        formatted = []
+        for value in values:
+            scaled = value * 1000
+            if 0 <= scaled < 1000.5:  # False for NaN
+                step = int(scaled + 0.5)
+                if -0.499999 < scaled - step < 0.499999:
+                    formatted.append(table[step])
+                    continue
+            elif not math.isfinite(value):
+                raise ValueError('Mix ratio must be a finite number, not %r' % value)
+            formatted.append(format(value, '.3f'))
+        return formatted
+
+    @staticmethod
+    def prefix(tool=0):
+        prefix = MixFormat._prefixes.get(tool)
+        if prefix is None:
+            prefix = MixFormat._prefixes[tool] = 'M567 P' + str(tool) + ' E'
+        return prefix
+
+    # M567 line for already formatted ratios
+    @staticmethod
+    def join(ratios, tool=0):
+        return MixFormat.prefix(tool) + ':'.join(ratios)
+
+    # M567 line for numeric ratios
+    @staticmethod
+    def command(values, tool=0):
+        return MixFormat.prefix(tool) + ':'.join(MixFormat.ratios(values))
+
+
+################################################################################
+#
+# LayerIndex
+#
+# Locates Cura's comment markers (;LAYER:, ;LAYER_COUNT:, ;FLAVOR:, ...) in
+# the per-layer data list in one scan, so scripts can jump straight to the
+# layers they modify instead of testing every line.
+#
+# Positions are (chunk, line) pairs, chunk being the index into data and line
+# the index into data[chunk].split('\n').
+#
+# Usage:
+#   index = LayerIndex(data)
+#   index.layerCount()      # value of ;LAYER_COUNT: as an int
+#   index.layer(12)         # position of ;LAYER:12 (not ;LAYER:120)
+#   index.marker('FLAVOR')  # (chunk, line, value) of the first ;FLAVOR:
+#   index.find(';Modified:') # position of any text
+#
+################################################################################
+
+class LayerIndex:
+    _markers = re.compile('^;(?P<name>[A-Z_]+):(?P<value>.*)$', re.M)
+    _number = re.compile('\\s*(?P<number>-?\\d+)')
+
+    def __init__(self, data):
+        self.data = data
+        self.layers = {}
+        self.markers = {}
+        for chunk, gcode in enumerate(data):
+            line = 0
+            last = 0
+            for match in LayerIndex._markers.finditer(gcode):
+                line += gcode.count('\n', last, match.start())
+                last = match.start()
+                name = match.group('name')
+                value = match.group('value').strip()
+                self.markers.setdefault(name, []).append((chunk, line, value))
+                if name == 'LAYER':
+                    number = LayerIndex._number.match(value)
+                    if number:
+                        self.layers.setdefault(int(number.group('number')), (chunk, line))
+
+    def layer(self, number):
+        return self.layers.get(number)
+
+    # First (chunk, line, value) of a marker, or None when it is missing
+    def marker(self, name):
+        found = self.markers.get(name)
+        return found[0] if found else None
+
+    def layerCount(self):
+        found = self.marker('LAYER_COUNT')
+        if found is None:
+            return None
+        number = LayerIndex._number.match(found[2])
+        return int(number.group('number')) if number else None
+
+    # Position of the first occurrence of text anywhere in data
+    def find(self, text):
+        for chunk, gcode in enumerate(self.data):
+            start = gcode.find(text)
+            if start >= 0:
+                return chunk, gcode.count('\n', 0, start)
+        return None
+
+
+################################################################################
+#
+# ExtrusionIndex
+#
+# Running total of the filament extruded up to every extrusion move of
+# Cura's per-layer data list, so the point a given length of filament before
+# any line is found with a binary search instead of reading back line by line.
+# Melt uses it to write mixes early by the volume of the mixing chamber.
+#
+# Totals are net of retractions and never go down, a retraction is only
+# counted again once the filament it pulled back is pushed out. M82 / M83,
+# G90 / G91 and G92 are followed as in FilamentUsage.
+#
+# Usage:
+#   extrusion = ExtrusionIndex(data)
+#   extrusion.total(index.layer(12))        # mm extruded before ;LAYER:12
+#   extrusion.before(index.layer(12), 9.5)  # (chunk, line) of the move 9.5mm earlier
+#   ExtrusionIndex.length(30.0, 1.75)       # mm of filament in 30mm3
+#
+################################################################################
+
+class ExtrusionIndex:
+    _lines = re.compile('\n[ \t]*(?:[Gg]0*[0-3](?![0-9])[^;\nEe]*[Ee]([-+]?[0-9]*\\.?[0-9]+)|([Mm]8[23]|[Gg]9[0-2])(?![0-9])([^;\n]*))')
+    _setE = re.compile('[Ee]\\s*([-+]?[0-9]*\\.?[0-9]+)')
+
+    def __init__(self, data):
+        self.keys = array('q')  # chunk << 32 | line of every extrusion move
+        self.totals = array('d')  # extruded once that move is done
+        relativeE = positioning = False
+        position = net = peak = 0.0
+        for chunk, gcode in enumerate(data):
+            text = '\n' + gcode
+            line = 0
+            last = 0
+            for match in ExtrusionIndex._lines.finditer(text):
+                line += text.count('\n', last, match.start())
+                last = match.start()
+                value = match.group(1)
+                if value is not None:
+                    value = float(value)
+                    if relativeE or positioning:
+                        net += value
+                        position += value
+                    else:
+                        net += value - position
+                        position = value
+                    if net > peak:
+                        peak = net
+                    self.keys.append(chunk << 32 | line)
+                    self.totals.append(peak)
+                    continue
+                code = match.group(2).upper()
+                if code == 'G92':
+                    words = match.group(3)
+                    setE = ExtrusionIndex._setE.search(words)
+                    if setE:
+                        position = float(setE.group(1))
+                    elif not words.strip():
+                        position = 0.0
+                elif code in ('M82', 'M83'):
+                    relativeE = code == 'M83'
+                else:
+                    positioning = code == 'G91'
+
+    # mm of filament that fill a volume in mm3
+    @staticmethod
+    def length(volume, diameter=1.75):
+        return volume / (math.pi * (diameter / 2) ** 2)
+
+    # Number of extrusion moves before a (chunk, line) position
+    def _count(self, position):
+        chunk, line = position
+        return bisect_left(self.keys, chunk << 32 | line)
+
+    # mm extruded before a (chunk, line) position
+    def total(self, position):
+        count = self._count(position)
+        return self.totals[count - 1] if count else 0.0
+
+    # (chunk, line) of the extrusion move from which at least length mm are
+    # extruded before position, the first move when there is not that much,
+    # or None when nothing is extruded before position
+    def before(self, position, length):
+        count = self._count(position)
+        if not count or length <= 0:
+            return None
+        index = bisect_right(self.totals, self.totals[count - 1] - length, 0, count)
+        key = self.keys[index]
+        return key >> 32, key & 0xffffffff
+
+
+################################################################################
+#
+# EditList
+#
+# Records line edits against Cura's per-layer data list and applies them in a
+# single step. Every changed chunk is rebuilt with one join, chunks without
+# edits are passed through untouched.
+#
+# Positions are the (chunk, line) pairs used by LayerIndex, lines are always
+# counted in the original chunk so recording order does not shift them.
+#
+# Usage:
+#   edits = EditList()
+#   edits.insertAfter(index.layer(12), ['M567 P0 E0.5:0.5'])
+#   edits.replace(index.marker('LAYER_COUNT')[:2], [';LAYER_COUNT:80'])
+#   edits.delete((3, 7))
+#   edits.insertedLines(3)  # lines chunk 3 gains, in order
+#   edits.apply(data)
+#
+################################################################################
+
+class EditList:
+    def __init__(self):
+        self.chunks = {}
+
+    def _edit(self, position):
+        chunk, line = position
+        lines = self.chunks.setdefault(chunk, {})
+        edit = lines.get(line)
+        if edit is None:
+            edit = lines[line] = [[], None, []]  # before, replacement, after
+        return edit
+
+    def insertBefore(self, position, lines):
+        self._edit(position)[0].extend(lines)
+
+    def insertAfter(self, position, lines):
+        self._edit(position)[2].extend(lines)
+
+    def replace(self, position, lines):
+        self._edit(position)[1] = list(lines)
+
+    def delete(self, position):
+        self._edit(position)[1] = []
+
+    def changedChunks(self):
+        return sorted(self.chunks)
+
+    # Lines the edits of a chunk add, in the order they will appear
+    def insertedLines(self, chunk):
+        lines = []
+        edits = self.chunks.get(chunk, {})
+        for line in sorted(edits):
+            before, replacement, after = edits[line]
+            lines.extend(before)
+            lines.extend(replacement or [])
+            lines.extend(after)
+        return lines
+
+    # Forgets every edit recorded for a chunk
+    def discard(self, chunk):
+        self.chunks.pop(chunk, None)
+
+    def apply(self, data):
+        for chunk, edits in self.chunks.items():
+            source = data[chunk].split('\n')
+            output = []
+            previous = 0
+            for line in sorted(edits):
+                before, replacement, after = edits[line]
+                output.extend(source[previous:line])
+                output.extend(before)
+                if replacement is None:
+                    output.append(source[line])
+                else:
+                    output.extend(replacement)
+                output.extend(after)
+                previous = line + 1
+            output.extend(source[previous:])
+            data[chunk] = '\n'.join(output)
+        self.chunks = {}
+        return data
+
+
+################################################################################
+#
+# MoveTable
+#
+# Gcode parsed once into a numpy structured array, one row per command line,
+# so analyses read columns instead of parsing text again. Rows are built in
+# chunks of chunkSize lines, only one chunk is held as Python tuples.
+#
+# Columns:
+#   code    command word, G01 read as G1 (b'G1', b'M567', b'T1', ...)
+#   x y z e f   words as written, NaN when missing
+#   tool    tool in effect, the T line itself included
+#   layer   number of the last ;LAYER: comment, -1 before the first
+#   flags   RELATIVE (G91) and RELATIVE_E (M83 or G91) in effect, G90
+#           returning E to the M82 / M83 mode as Marlin does
+#   line    line offset in the source, used to splice lines back in
+#
+# The tool and flags columns are filled by forward fills over the whole
+# array, position() does the same for absolute X / Y / Z / E, which is what
+# Miso.Gcode.updateTool / updateRelative / updateZ do one line at a time.
+#
+# Usage:
+#   table = MoveTable(lines)
+#   table.rows['tool']                   # tool of every command
+#   table.position('Z')                  # absolute Z after every command
+#   table.rows[table.extrusions()]       # rows of the moves that extrude
+#   MoveTable.splice(lines, [(12, 'M567 P0 E0.5:0.5')])  # before line 12
+#
+################################################################################
+
+class MoveTable:
+    RELATIVE = 1
+    RELATIVE_E = 2
+    _columns = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
+    _words = re.compile(' ([XYZEF])([^ ]*)')
+    _moves = (b'G0', b'G1', b'G2', b'G3')
+
+    @staticmethod
+    def dtype():
+        return numpy.dtype([('code', 'S6'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('e', 'f8'), ('f', 'f8'),
+                            ('tool', 'i2'), ('layer', 'i4'), ('flags', 'u1'), ('line', 'i8')])
+
+    def __init__(self, gcode, chunkSize=65536):
+        if numpy is None:
+            raise ImportError('MoveTable needs numpy')
+        dtype = MoveTable.dtype()
+        parse = Miso.Lexer.parse
+        columns = MoveTable._columns
+        words = MoveTable._words.findall
+        missing = float('nan')
+        chunks = []
+        rows = []
+        layer = -1
+        for offset, line in enumerate(gcode):
+            line = line.rstrip('\r\n')
+            if line.startswith(';LAYER:'):
+                number = LayerIndex._number.match(line, 7)
+                if number:
+                    layer = int(number.group('number'))
+                continue
+            command = parse(line)
+            if command is None:
+                continue
+            values = [missing] * 5
+            for letter, value in words(command.body):
+                try:
+                    values[columns[letter]] = float(value)
+                except ValueError:
+                    pass
+            code = command.code if command.code.isascii() else ''
+            tool = int(code[1:]) if code[:1] == 'T' and code[1:].isdigit() else -1
+            rows.append((code, values[0], values[1], values[2], values[3], values[4], tool, layer, 0, offset))
+            if len(rows) >= chunkSize:
+                chunks.append(numpy.array(rows, dtype=dtype))
+                rows = []
+        chunks.append(numpy.array(rows, dtype=dtype))
+        self.rows = numpy.concatenate(chunks)
+        self._track()
+
+    # Index of the last row at or before every row where mask is set, -1 when there is none
+    @staticmethod
+    def _lastIndex(mask):
+        index = numpy.where(mask, numpy.arange(len(mask)), -1)
+        numpy.maximum.accumulate(index, out=index)
+        return index
+
+    # values carried forward from the rows where mask is set, initial before the first
+    @staticmethod
+    def _fill(mask, values, initial):
+        index = MoveTable._lastIndex(mask)
+        return numpy.where(index >= 0, values[numpy.maximum(index, 0)], initial)
+
+    def _track(self):
+        rows = self.rows
+        code = rows['code']
+        tools = rows['tool']
+        rows['tool'] = MoveTable._fill(tools >= 0, tools, 0)
+        absolute = code == b'G90'
+        relative = code == b'G91'
+        positioning = MoveTable._fill(absolute | relative, relative, False)
+        extrusion = MoveTable._fill((code == b'M82') | (code == b'M83'), code == b'M83', False)
+        rows['flags'] = positioning * MoveTable.RELATIVE | (positioning | extrusion) * MoveTable.RELATIVE_E
+
+    # G0 to G3
+    def moves(self):
+        return numpy.isin(self.rows['code'], MoveTable._moves)
+
+    # Moves with an E word
+    def extrusions(self):
+        return self.moves() & ~numpy.isnan(self.rows['e'])
+
+    # Absolute position of an axis (X, Y, Z or E) after every row, starting at 0
+    # Relative words are summed from the last absolute word or G92, so long
+    # relative runs can differ from a line by line sum in the last digits
+    def position(self, axis):
+        rows = self.rows
+        values = rows[axis.lower()]
+        given = ~numpy.isnan(values)
+        moves = self.moves()
+        flag = MoveTable.RELATIVE_E if axis.upper() == 'E' else MoveTable.RELATIVE
+        relative = (rows['flags'] & flag) != 0
+        total = numpy.cumsum(numpy.where(given & moves & relative, values, 0.0))
+        index = MoveTable._lastIndex(given & ((moves & ~relative) | (rows['code'] == b'G92')))
+        anchor = numpy.maximum(index, 0)
+        return numpy.where(index >= 0, values[anchor] + (total - total[anchor]), total)
+
+    # Filament extruded up to and including every row, net of retractions and
+    # never going down, so it can be searched with numpy.searchsorted
+    # G92 resets of E are not counted as extrusion
+    def extruded(self):
+        positions = self.position('E')
+        steps = numpy.diff(positions, prepend=0.0)
+        steps[self.rows['code'] == b'G92'] = 0.0
+        return numpy.maximum.accumulate(numpy.cumsum(steps)) if len(steps) else steps
+
+    # Extrusions whose (tool, Z, relative) differs from the extrusion before,
+    # or from the starting state for the first, as a mask over the rows
+    # These are the lines Miso.streamGcode decides a mix for
+    def extrusionChanges(self):
+        rows = self.rows
+        extrusions = numpy.flatnonzero(self.extrusions())
+        tools = rows['tool'][extrusions]
+        heights = self.position('Z')[extrusions]
+        relative = (rows['flags'][extrusions] & MoveTable.RELATIVE) != 0
+        changed = numpy.empty(len(extrusions), dtype=bool)
+        if len(extrusions):
+            changed[0] = tools[0] != 0 or heights[0] != 0 or relative[0]
+            changed[1:] = (tools[1:] != tools[:-1]) | (heights[1:] != heights[:-1]) | (relative[1:] != relative[:-1])
+        mask = numpy.zeros(len(rows), dtype=bool)
+        mask[extrusions[changed]] = True
+        return mask
+
+    # Source lines with text inserted before the lines at the given offsets,
+    # inserts being (line offset, text) pairs, yielded in chunks of about
+    # chunkSize lines like Miso.streamGcode
+    # Inserts for the same line keep their order, offsets past the end are
+    # written after the last line
+    @staticmethod
+    def splice(gcode, inserts, chunkSize=4096):
+        inserts = sorted(inserts, key=lambda insert: insert[0])
+        position = 0
+        buffer = []
+        for offset, line in enumerate(gcode):
+            while position < len(inserts) and inserts[position][0] <= offset:
+                buffer.append(inserts[position][1] + '\n')
+                position += 1
+            buffer.append(line.rstrip('\r\n') + '\n')
+            if len(buffer) >= chunkSize:
+                yield ''.join(buffer)
+                buffer = []
+        for offset, text in inserts[position:]:
+            buffer.append(text + '\n')
+        if buffer:
+            yield ''.join(buffer)
+
+
+################################################################################
+#
+# MixFilter
+#
+# Drops M567 mix commands that cannot change the print: a mix identical to
+# the one already in effect for its tool, or a mix that is replaced by
+# another for the same tool before anything extrudes. Running Melt several
+# times stacks exactly these.
+#
+# Only the M567 lines and the gcode between them are searched, with regular
+# expressions, so chunks without mixes cost a single substring check.
+# Anything that may extrude, change or redefine a tool (moves with an E
+# word, G10 / G11, M563, M568, T<n>) ends the window in which a mix can
+# still be replaced. A tool selected by T<n> or redefined by M563 (every
+# tool when it has no P) has no known mix until its next M567.
+#
+# Usage:
+#   removed = MixFilter().apply(data)   # Cura's per-layer data list, edited in place
+#
+################################################################################
+
+class MixFilter:
+    _mixes = re.compile('^[ \t]*[Mm]567(?![0-9])[^\n]*', re.M)
+    _barriers = re.compile('^[ \t]*(?:[Gg]0*[0-3](?![0-9])[^;\n]*[Ee]|[Gg]1[01](?![0-9])|[Mm]56[38](?![0-9])|[Tt][0-9])', re.M)
+    _words = re.compile('([PpEe])\\s*([-+0-9.:]+)')
+    _definitions = re.compile('^[ \t]*[Mm]563(?![0-9])([^;\n]*)', re.M)
+    _changes = re.compile('\n[ \t]*[Tt]([0-9]+)')  # starting with a literal searches much faster than re.M
+    _firstChange = re.compile('[ \t]*[Tt]([0-9]+)')
+    _tool = re.compile('[Pp]\\s*([0-9]+)')
+
+    def __init__(self):
+        self.active = {}   # tool -> mix in effect
+        self.pending = {}  # tool -> (position, mix) not yet used by an extrusion
+        self.removed = 0
+
+    # (tool, mix) of an M567 line, mix being None when there is no E word
+    @staticmethod
+    def parse(line):
+        tool = 0
+        mix = None
+        for name, value in MixFilter._words.findall(line.split(';', 1)[0]):
+            try:
+                if name in 'Pp':
+                    tool = int(float(value))
+                else:
+                    mix = tuple(float(part) for part in value.split(':'))
+            except ValueError:
+                return tool, None
+        return tool, mix
+
+    def _commit(self):
+        for tool, (position, mix) in self.pending.items():
+            self.active[tool] = mix
+        self.pending = {}
+
+    def _barrier(self, gcode, start, end):
+        if self.pending and MixFilter._barriers.search(gcode, start, end):
+            self._commit()
+        if self.active and (gcode.find('M563', start, end) >= 0 or gcode.find('m563', start, end) >= 0):
+            for match in MixFilter._definitions.finditer(gcode, start, end):
+                tool = MixFilter._tool.search(match.group(1))
+                if tool is None:
+                    self.active = {}
+                else:
+                    self.active.pop(int(tool.group(1)), None)
+        if self.active:
+            tools = MixFilter._changes.findall(gcode, max(start - 1, 0), end)
+            first = MixFilter._firstChange.match(gcode, 0, end) if start == 0 else None
+            if first is not None:
+                tools.append(first.group(1))
+            for tool in tools:
+                self.active.pop(int(tool), None)
+
+    def apply(self, data):
+        edits = EditList()
+        for chunk, gcode in enumerate(data):
+            if 'M567' not in gcode and 'm567' not in gcode:
+                self._barrier(gcode, 0, len(gcode))
+                continue
+            line = 0
+            last = 0
+            for match in MixFilter._mixes.finditer(gcode):
+                self._barrier(gcode, last, match.start())
+                line += gcode.count('\n', last, match.start())
+                last = match.start()
+                tool, mix = MixFilter.parse(match.group(0))
+                if mix is None:  # not understood, keep it and forget what we knew
+                    self._commit()
+                    self.active.pop(tool, None)
+                    continue
+                replaced = self.pending.pop(tool, None)
+                if replaced is not None:
+                    edits.delete(replaced[0])
+                    self.removed += 1
+                if mix == self.active.get(tool):
+                    edits.delete((chunk, line))
+                    self.removed += 1
+                else:
+                    self.pending[tool] = ((chunk, line), mix)
+            self._barrier(gcode, last, len(gcode))
+        edits.apply(data)
+        return self.removed
+
+
+################################################################################
+#
+# FilamentUsage
+#
+# Works out how much of each filament a print uses before it is printed, so
+# spools can be staged. Every extrusion is split across the drives of its
+# tool by the M567 mix in effect, the way the firmware moves them.
+#
+# Only the lines that change how E is read are parsed one by one: M82 / M83,
+# G90 / G91, G92, tool changes, M563 / M567 and ;LAYER: comments. Between two
+# of them the E words are collected with one regular expression and either
+# summed (relative E) or only the last one read (absolute E), so retractions
+# cancel out and filament is counted net of them. G91 makes E relative too
+# and G90 returns it to the M82 / M83 mode, as Marlin does.
+#
+# A tool without an M567 feeds its first drive. Drives are numbered as in
+# M563 P<tool> D<drives>, or by their place in the mix when there is none.
+# Lengths are mm of filament, grams need the diameter and density.
+#
+# Usage:
+#   usage = FilamentUsage()
+#   for chunk in data:                    # in order, chunks end on a line
+#       usage.scan(chunk)
+#   usage.totals                          # {drive: mm}
+#   usage.layers                          # {layer: {drive: mm}}, -1 before the first
+#   usage.asDict(diameter=1.75, density=1.24)
+#   usage.write('print.gcode.usage.json')
+#
+################################################################################
+
+class FilamentUsage:
+    _states = re.compile('\n[ \t]*(?:(?:[Mm](?:8[23]|56[37])|[Gg]9[0-2]|[Tt][0-9]+)(?![0-9])|;LAYER:)[^\n]*')
+    _extrusions = re.compile('\n[ \t]*[Gg]0*[0-3](?![0-9])[^;\nEe]*[Ee]([-+]?[0-9]*\\.?[0-9]+)')
+    _words = re.compile('([A-Z])\\s*([-+0-9.:]+)')
+
+    def __init__(self):
+        self.totals = {}
+        self.layers = {}
+        self.layer = -1
+        self.tool = 0
+        self.relative = False
+        self.relativeE = False
+        self.positioning = False
+        self.position = 0.0
+        self.mixes = {}
+        self.drives = {}
+        self._split = None
+
+    def scan(self, text):
+        text = '\n' + text  # every line, the first included, then follows a newline
+        start = 0
+        for match in FilamentUsage._states.finditer(text):
+            self._extrude(text, start, match.start())
+            self._state(match.group())
+            start = match.end()
+        self._extrude(text, start, len(text))
+
+    def scanFile(self, path, blockSize=1 << 24):
+        with open(path, encoding='utf-8', errors='replace') as source:
+            rest = ''
+            while True:
+                block = source.read(blockSize)
+                if not block:
+                    break
+                end = block.rfind('\n') + 1
+                self.scan(rest + block[:end])
+                rest = block[end:]
+            self.scan(rest)
+
+    # Net E of the extrusions between start and end, both at a newline
+    def _extrude(self, text, start, end):
+        if self.relative:
+            values = FilamentUsage._extrusions.findall(text, start, end)
+            if not values:
+                return
+            amount = sum(map(float, values))
+            self.position += amount
+        else:
+            last = FilamentUsage._lastExtrusion(text, start, end)
+            if last is None:
+                return
+            amount = last - self.position
+            self.position = last
+        if not amount:
+            return
+        if self._split is None:
+            self._split = self._drives()
+        layer = self.layers.get(self.layer)
+        if layer is None:
+            layer = self.layers[self.layer] = {}
+        totals = self.totals
+        for drive, ratio in self._split:
+            totals[drive] = totals.get(drive, 0.0) + amount * ratio
+            layer[drive] = layer.get(drive, 0.0) + amount * ratio
+
+    # E word of the last extrusion, found by reading lines back from end
+    @staticmethod
+    def _lastExtrusion(text, start, end):
+        match = FilamentUsage._extrusions.match
+        while end > start:
+            line = text.rfind('\n', start, end)
+            if line < 0:
+                return None
+            found = match(text, line, end)
+            if found:
+                return float(found.group(1))
+            end = line
+        return None
+
+    # (drive, ratio) pairs of the active tool
+    def _drives(self):
+        tool = self.tool
+        drives = self.drives.get(tool)
+        mix = self.mixes.get(tool)
+        if mix is None:
+            return [(drives[0] if drives else tool, 1.0)]
+        if drives is None:
+            drives = range(len(mix))
+        return [(drive, ratio) for drive, ratio in zip(drives, mix)]
+
+    def _state(self, line):
+        if line.lstrip().startswith(';'):
+            number = LayerIndex._number.match(line.lstrip()[7:])
+            if number:
+                self.layer = int(number.group('number'))
+            return
+        body = line.split(';', 1)[0].strip().upper()
+        code = body.split(None, 1)[0]
+        words = dict(FilamentUsage._words.findall(body[len(code):]))
+        if code in ('M82', 'M83'):
+            self.relativeE = code == 'M83'
+            self.relative = self.relativeE or self.positioning
+        elif code in ('G90', 'G91'):
+            self.positioning = code == 'G91'
+            self.relative = self.relativeE or self.positioning
+        elif code == 'G92':
+            if 'E' in words:
+                self.position = FilamentUsage._number(words['E'], self.position)
+            elif not words:
+                self.position = 0.0
+        elif code[0] == 'T':
+            if code[1:].isdigit():
+                self.tool = int(code[1:])
+        else:
+            tool = int(FilamentUsage._number(words.get('P'), self.tool))
+            values = words.get('D' if code == 'M563' else 'E')
+            if values is not None:
+                try:
+                    if code == 'M563':
+                        self.drives[tool] = [int(value) for value in values.split(':')]
+                    else:
+                        self.mixes[tool] = [float(value) for value in values.split(':')]
+                except ValueError:
+                    pass
+        self._split = None
+
+    @staticmethod
+    def _number(text, default):
+        try:
+            return float(text)
+        except (TypeError, ValueError):
+            return default
+
+    def total(self):
+        return sum(self.totals.values())
+
+    # Grams of a length of filament
+    @staticmethod
+    def grams(length, diameter=1.75, density=1.24):
+        return length * math.pi * (diameter / 2) ** 2 * density / 1000
+
+    def asDict(self, diameter=1.75, density=1.24):
+        return {
+            'diameter': diameter,
+            'density': density,
+            'total_mm': self.total(),
+            'total_grams': FilamentUsage.grams(self.total(), diameter, density),
+            'drives': {str(drive): {'mm': length, 'grams': FilamentUsage.grams(length, diameter, density)}
+                       for drive, length in sorted(self.totals.items())},
+            'layers': {str(layer): {str(drive): length for drive, length in sorted(drives.items())}
+                       for layer, drives in sorted(self.layers.items())},
+        }
+
+    def write(self, path, diameter=1.75, density=1.24):
+        with open(path, 'w') as output:
+            json.dump(self.asDict(diameter, density), output, indent=2)
+            output.write('\n')
+
+
+################################################################################
+#
+# Instrumentation
+#
+# Opt-in report of where a run spent its time: timers per phase, counters and
+# the peak memory of the run. Nothing is written into the gcode, the report
+# is read from the object or saved as a JSON sidecar.
+#
+# Instrumentation.disabled() is a shared report whose methods do nothing, so
+# scripts can call it unconditionally. Counters that cost work to gather
+# should check report.enabled first.
+#
+# Peak memory uses tracemalloc, which slows the traced run down. Pass
+# memory=False when the timings matter more.
+#
+# start and stop nest, only the outermost pair times the total and traces
+# memory, so a runner can cover a script that starts and stops its own report.
+#
+# Usage:
+#   report = Instrumentation()
+#   report.start()
+#   with report.phase('parse'):
+#       index = LayerIndex(data)
+#   report.count('m567_emitted', 12)
+#   report.set('modifier', 'wood')
+#   report.stop()
+#   report.asDict()           # {'phases': {...}, 'counters': {...}, ...}
+#   report.write('print.gcode.json')
+#
+################################################################################
+
+class Instrumentation:
+    enabled = True
+    _disabled = None
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.values = OrderedDict()
+        self.peakMemory = None
+        self._started = None
+        self._tracing = False
+        self._depth = 0
+
+    @staticmethod
+    def disabled():
+        if Instrumentation._disabled is None:
+            Instrumentation._disabled = Instrumentation.Disabled()
+        return Instrumentation._disabled
+
+    def start(self):
+        self._depth += 1
+        if self._depth > 1:
+            return
+        self._started = time.perf_counter()
+        # An outer tracer (a benchmark, a profiler) is left alone and its peak reused
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        elif self.memory:
+            tracemalloc.reset_peak()
+
+    def stop(self):
+        self._depth = max(0, self._depth - 1)
+        if self._depth > 0:
+            return
+        if self._started is not None:
+            self.addTime('total', time.perf_counter() - self._started)
+            self._started = None
+        if self.memory and tracemalloc.is_tracing():
+            self.peakMemory = tracemalloc.get_traced_memory()[1]
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def phase(self, name):
+        return Instrumentation.Phase(self, name)
+
+    def addTime(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def asDict(self):
+        return {
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+            'values': dict(self.values),
+            'peak_memory': self.peakMemory,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.asDict(), output, indent=2)
+            output.write('\n')
+
+    # Times the body of a with block into its phase
+    class Phase:
+        __slots__ = ('report', 'name', 'started')
+
+        def __init__(self, report, name):
+            self.report = report
+            self.name = name
+
+        def __enter__(self):
+            self.started = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            self.report.addTime(self.name, time.perf_counter() - self.started)
+            return False
+
+    # Report that records nothing, shared by every disabled run
+    class Disabled:
+        enabled = False
+
+        class Phase:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        _phase = Phase()
+
+        def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def phase(self, name):
+            return self._phase
+
+        def addTime(self, name, seconds):
+            pass
+
+        def count(self, name, amount=1):
+            pass
+
+        def set(self, name, value):
+            pass
+
+        def asDict(self):
+            return {}
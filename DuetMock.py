@@ -0,0 +1,179 @@
+################################################################################
+#
+# MELT Duet Mock
+#
+# Local stand in for a Duet board's HTTP interface, enough of it to try and
+# test Upload.py without a printer: rr_connect, rr_disconnect and rr_upload
+# with chunked or Content-Length bodies and the crc32 check.
+#
+# Faults can be switched on to exercise the uploader: dropping the
+# connection during the first uploads, refusing chunked bodies like a board
+# that needs the length up front, and reading slowly so the uploader has to
+# wait on the network.
+#
+# Usage:
+#   python DuetMock.py --port 8080 --directory received
+#   python DuetMock.py --port 8080 --fail 2 --require-length --read-delay 0.01
+#
+#   From asyncio code:
+#       async with DuetMock(fail=1) as duet:
+#           await Upload.upload_async('melt', 'in.gcode', duet.url, '0:/gcodes/out.gcode', {})
+#           duet.files['0:/gcodes/out.gcode']   # bytes received
+#
+################################################################################
+
+import argparse
+import asyncio
+import binascii
+import json
+import os
+import sys
+import urllib.parse
+
+BLOCK_SIZE = 65536
+
+
+class DuetMock:
+    def __init__(self, host='127.0.0.1', port=0, password='', directory=None, fail=0, require_length=False,
+                 read_delay=0.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.directory = directory
+        self.fail = fail  # uploads still to drop
+        self.require_length = require_length
+        self.read_delay = read_delay
+        self.files = {}
+        self.requests = []  # (method, path) of every request, in order
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+        return False
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            if not request:
+                return
+            method, target = request.decode('latin-1').split()[:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            parts = urllib.parse.urlsplit(target)
+            self.requests.append((method, parts.path))
+            reply = await self.route(method, parts.path, dict(urllib.parse.parse_qsl(parts.query)), headers, reader)
+            if reply is None:  # a dropped connection
+                writer.transport.abort()
+                return
+            status, body = reply
+            body = json.dumps(body).encode('utf-8')
+            writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                         b'Connection: close\r\n\r\n' % (status, b'OK' if status == 200 else b'Error', len(body)) + body)
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass  # the client went away mid request, nothing is stored
+        finally:
+            writer.close()
+
+    # (status, JSON reply) for a request, None to drop the connection
+    async def route(self, method, path, query, headers, reader):
+        if path == '/rr_connect':
+            if query.get('password', '') != self.password:
+                return 200, {'err': 1}
+            return 200, {'err': 0, 'sessionTimeout': 8000, 'boardType': 'mock', 'apiLevel': 1}
+        if path == '/rr_disconnect':
+            return 200, {'err': 0}
+        if path == '/rr_upload' and method == 'POST':
+            chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+            if chunked and self.require_length:
+                return 411, {'err': 1}
+            if self.fail > 0:
+                self.fail -= 1
+                await reader.read(BLOCK_SIZE)
+                return None
+            body = await (self.read_chunked(reader) if chunked else self.read_length(reader, int(headers.get('content-length', 0))))
+            if 'crc32' in query and int(query['crc32'], 16) != binascii.crc32(body):
+                return 200, {'err': 1}
+            self.store(query.get('name', ''), body)
+            return 200, {'err': 0}
+        return 404, {'err': 1}
+
+    async def read_chunked(self, reader):
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return b''.join(parts)
+            parts.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+            if self.read_delay:
+                await asyncio.sleep(self.read_delay)
+
+    async def read_length(self, reader, length):
+        parts = []
+        while length > 0:
+            part = await reader.readexactly(min(length, BLOCK_SIZE))
+            parts.append(part)
+            length -= len(part)
+            if self.read_delay:
+                await asyncio.sleep(self.read_delay)
+        return b''.join(parts)
+
+    def store(self, name, body):
+        self.files[name] = body
+        if self.directory:
+            path = os.path.join(self.directory, os.path.basename(name.split(':', 1)[-1]))
+            with open(path, 'wb') as output:
+                output.write(body)
+
+
+async def serve(mock):
+    async with mock:
+        print('Duet mock listening on ' + mock.url)
+        await asyncio.Event().wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stand in for a Duet board to test uploads without a printer.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--password', default='', help='password rr_connect expects')
+    parser.add_argument('--directory', help='write received files here')
+    parser.add_argument('--fail', type=int, default=0, help='drop the connection during this many uploads first')
+    parser.add_argument('--require-length', action='store_true', help='answer chunked uploads with 411 Length Required')
+    parser.add_argument('--read-delay', type=float, default=0.0, help='seconds to pause after every piece read')
+    args = parser.parse_args(argv)
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+    mock = DuetMock(args.host, args.port, args.password, args.directory, args.fail, args.require_length, args.read_delay)
+    try:
+        asyncio.run(serve(mock))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
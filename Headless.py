@@ -0,0 +1,388 @@
+################################################################################
+#
+# MELT Headless Runner
+#
+# Runs Melt, ColorShift or Miso on a gcode file without Cura, for slicing
+# servers that post-process outside the GUI.
+#
+# The input is memory-mapped and split into Cura-style layer chunks (the
+# part before the first ;LAYER: followed by one chunk per layer) that are
+# only decoded when a script reads them. Chunks a script never replaces are
+# copied straight from the map to the output, so two full copies of the
+# print are never held in memory.
+#
+# Usage:
+#   python Headless.py melt input.gcode output.gcode --settings melt.json
+#   python Headless.py melt input.gcode output.gcode --set change_rate=8 --set e_trigger=wood
+#   python Headless.py colorshift input.gcode output.gcode
+#   python Headless.py miso input.gcode output.gcode --settings tools.json
+#   python Headless.py melt input.gcode output.gcode --report output.json
+#   python Headless.py usage input.gcode usage.json --set diameter=1.75 --set density=1.24
+#
+#   usage writes the filament each drive uses, in total and per layer, as
+#   JSON instead of gcode, see FilamentUsage in CoreLibrary.py.
+#
+#   --report writes the phase timings, counters and peak memory of the run
+#   as JSON, see Instrumentation in CoreLibrary.py.
+#
+#   Melt and ColorShift settings use the keys from their getSettingDataString,
+#   anything not given keeps its default value.
+#
+#   Miso settings:
+#       {
+#           "zmax": 80.0,        # optional, Cura's ;MAXZ: or the highest extruding Z when missing
+#           "workers": 8,        # optional, converts across processes
+#           "tolerance": 0.01,   # optional, largest mix ratio error, fewer M567 in vase mode
+#           "mixing_volume": 30, # optional, mm3 in the mixing chamber, mixes are written that early
+#           "filament_diameter": 1.75,
+#           "tools": {"0": [{"mix": [1, 0], "z": 0}, {"mix": [0, 1], "z": 1}]}
+#       }
+#
+#   A tool can also be a side to side or corner to corner gradient, its stops
+#   then giving the fraction of the way along the axis, see Miso.Tool:
+#       "tools": {"0": {"axis": [1, 1, 0], "stops": [{"mix": [1, 0], "z": 0}, {"mix": [0, 1], "z": 1}]}}
+#
+################################################################################
+
+import argparse
+import importlib
+import json
+import mmap
+import os
+import re
+import sys
+import tempfile
+import types
+
+# Melt and ColorShift import ..Script and .CoreLibrary as Cura plugin scripts,
+# so they are loaded as PACKAGE.scripts.<name> next to a stub PACKAGE.Script
+PACKAGE = 'melt_headless'
+
+
+# Local stand in for Cura's Script class
+# Settings start at the defaults declared in getSettingDataString and are
+# converted to the declared type when set, like Cura's settings would be
+class Script:
+    def __init__(self):
+        self._settings = {}
+        self._types = {}
+        for key, setting in json.loads(self.getSettingDataString())['settings'].items():
+            self._settings[key] = setting.get('default_value')
+            self._types[key] = setting.get('type')
+
+    def getSettingDataString(self):
+        raise NotImplementedError()
+
+    def getSettingValueByKey(self, key):
+        return self._settings.get(key)
+
+    def setSettingValueByKey(self, key, value):
+        if key not in self._types:
+            raise KeyError('Unknown setting: ' + key)
+        kind = self._types[key]
+        if kind == 'float':
+            value = float(value)
+        elif kind == 'int':
+            value = int(float(value))
+        elif kind == 'bool':
+            value = value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(value, (list, dict)):  # structured settings such as Melt's segments
+            value = json.dumps(value)
+        else:
+            value = str(value)
+        self._settings[key] = value
+
+
+def install_package():
+    if PACKAGE in sys.modules:
+        return
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = []
+    script = types.ModuleType(PACKAGE + '.Script')
+    script.Script = Script
+    scripts = types.ModuleType(PACKAGE + '.scripts')
+    scripts.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    package.Script = script
+    package.scripts = scripts
+    sys.modules[PACKAGE] = package
+    sys.modules[PACKAGE + '.Script'] = script
+    sys.modules[PACKAGE + '.scripts'] = scripts
+
+
+def load_module(name):
+    install_package()
+    return importlib.import_module(PACKAGE + '.scripts.' + name)
+
+
+# Miso for the settings. With workers the pool's processes have to import
+# it by name, and spawned ones never see PACKAGE, so CoreLibrary is then
+# imported as a plain module from this folder
+def load_miso(settings):
+    if int(settings.get('workers', 0)) > 1:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        if folder not in sys.path:
+            sys.path.append(folder)
+        return importlib.import_module('CoreLibrary').Miso
+    return load_module('CoreLibrary').Miso
+
+
+# Cura's per-layer data list backed by a memory-mapped file
+# Chunks are decoded on access, replaced chunks are kept until written
+class LayerChunks:
+    _layerStart = b'\n;LAYER:'
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.replaced = {}
+        self.bounds = [0]
+        position = self.map.find(self._layerStart)
+        while position >= 0:
+            self.bounds.append(position + 1)
+            position = self.map.find(self._layerStart, position + 1)
+        self.bounds.append(self.size)
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index in self.replaced:
+            return self.replaced[index]
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.map[self.bounds[index]:self.bounds[index + 1]].decode('utf-8')
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += len(self)
+        self.replaced[index] = value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    # The file as it is now, in bytes pieces of a chunk each
+    def pieces(self):
+        for index in range(len(self)):
+            if index in self.replaced:
+                yield self.replaced[index].encode('utf-8')
+            else:
+                yield self.map[self.bounds[index]:self.bounds[index + 1]]
+
+    def write(self, output):
+        for piece in self.pieces():
+            output.write(piece)
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+
+# Writes through a temporary file so the input can also be the output
+def write_atomic(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp = tempfile.mkstemp(dir=directory, suffix='.gcode')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            write(output)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def load_script(name, settings, report=None):
+    module = load_module(name)
+    script = getattr(module, name)()
+    for key, value in settings.items():
+        script.setSettingValueByKey(key, value)
+    script.instrumentation = report
+    return script
+
+
+# The report covers the script and writing its output, the script's own
+# start and stop nest inside
+def run_script(name, source, target, settings, report=None):
+    report = report or load_module('CoreLibrary').Instrumentation.disabled()
+    report.start()
+    script = load_script(name, settings, report)
+    chunks = LayerChunks(source)
+    try:
+        script.execute(chunks)
+        with report.phase('write'):
+            write_atomic(target, chunks.write)
+    finally:
+        chunks.close()
+    report.stop()
+
+
+_maxZ = re.compile(b'^;MAXZ:(-?\\d+\\.?\\d*)', re.M)
+
+
+# Highest Z the print extrudes at, used when zmax is not given
+# Cura's ;MAXZ: header when the file has one, otherwise the moves are
+# followed through G90 / G91, so the relative Z hop of an end gcode
+# (G91, G1 Z10) and the retractions around it are not counted
+def find_zmax(Miso, chunks):
+    header = _maxZ.search(chunks.map, 0, chunks.bounds[1])
+    if header is not None:
+        return float(header.group(1))
+    zmax = 0.0
+    state = Miso.State()
+    for line in Miso.iterLines(chunks):
+        command = Miso.Lexer.parse(line)
+        if command is not None and state.update(command) and (command.value('E') or 0) > 0 and \
+                (command.value('X') is not None or command.value('Y') is not None):
+            zmax = max(zmax, state.zpos)
+    return zmax
+
+
+# Every run starts from the default Miso, a batch worker converts many jobs
+# and none may keep the tools or tolerance of the one before
+def configure_miso(Miso, settings):
+    Miso.reset()
+    if 'tolerance' in settings:
+        Miso.setMixCache(tolerance=float(settings['tolerance']))
+    Miso.setMixingVolume(float(settings.get('mixing_volume', 0)), float(settings.get('filament_diameter', 1.75)))
+    for tool, config in settings.get('tools', {}).items():
+        stops = config['stops'] if isinstance(config, dict) else config
+        axis = config.get('axis') if isinstance(config, dict) else None
+        mixes = [Miso.Mix(stop['mix'], stop.get('z', 0)) for stop in stops]
+        Miso.setToolConfig(int(tool), Miso.Tool(mixes, axis))
+
+
+# Converted chunks of text, with the zmax and workers used
+def convert_miso(Miso, chunks, settings):
+    zmax = float(settings.get('zmax') or find_zmax(Miso, chunks) or 1)
+    workers = int(settings.get('workers', 0))
+    lines = Miso.iterLines(chunks)
+    if Miso.needsTable():  # the bounding box and extrusion totals need every line at once
+        converted = Miso.streamTable(list(lines), zmax)
+    elif workers > 1:  # the parallel prescan needs every line at once
+        converted = Miso.streamGcodeParallel(list(lines), zmax, workers)
+    else:
+        converted = Miso.streamGcode(lines, zmax)
+    return converted, zmax, workers
+
+
+# Miso parses and emits in one streaming pass, so its report has a single
+# convert phase and counts lines from the output
+def run_miso(source, target, settings, report=None):
+    Miso = load_miso(settings)
+    report = report or load_module('CoreLibrary').Instrumentation.disabled()
+    report.start()
+    configure_miso(Miso, settings)
+    cache = Miso.mixCache().stats()
+    chunks = LayerChunks(source)
+    try:
+        converted, zmax, workers = convert_miso(Miso, chunks, settings)
+
+        def write(output):
+            for chunk in converted:
+                output.write(chunk.encode('utf-8'))
+                if report.enabled:
+                    report.count('lines_written', chunk.count('\n'))
+                    report.count('m567_emitted', chunk.count('M567 '))
+        with report.phase('convert'):
+            write_atomic(target, write)
+    finally:
+        chunks.close()
+    if report.enabled:
+        stats = Miso.mixCache().stats()
+        report.count('cache_hits', stats['hits'] - cache['hits'])
+        report.count('cache_misses', stats['misses'] - cache['misses'])
+        report.set('zmax', zmax)
+        report.set('workers', workers)
+        report.set('tolerance', Miso.mixCache().tolerance)
+    report.stop()
+
+
+# Filament per drive, written as JSON to target
+def run_usage(source, target, settings, report=None):
+    core = load_module('CoreLibrary')
+    report = report or core.Instrumentation.disabled()
+    report.start()
+    usage = core.FilamentUsage()
+    chunks = LayerChunks(source)
+    try:
+        with report.phase('scan'):
+            for chunk in chunks:
+                usage.scan(chunk)
+    finally:
+        chunks.close()
+    usage.write(target, float(settings.get('diameter', 1.75)), float(settings.get('density', 1.24)))
+    if report.enabled:
+        report.count('bytes_scanned', chunks.size)
+        report.set('total_mm', usage.total())
+    report.stop()
+
+
+SCRIPTS = {'melt': 'Melt', 'colorshift': 'ColorShift'}
+STREAMS = sorted(list(SCRIPTS) + ['miso'])
+
+
+# Output of a transform as bytes pieces in file order, for writers that are
+# not a local file (see Upload.py)
+# Melt and ColorShift finish before the first piece, Miso converts as it goes
+def stream(transform, source, settings, report=None):
+    chunks = LayerChunks(source)
+    try:
+        if transform == 'miso':
+            Miso = load_miso(settings)
+            configure_miso(Miso, settings)
+            converted = convert_miso(Miso, chunks, settings)[0]
+            for piece in converted:
+                yield piece.encode('utf-8')
+        else:
+            script = load_script(SCRIPTS[transform], settings, report)
+            script.execute(chunks)
+            for piece in chunks.pieces():
+                yield piece
+    finally:
+        chunks.close()
+
+
+def read_settings(path, overrides):
+    settings = {}
+    if path:
+        with open(path) as source:
+            settings = json.load(source)
+    for override in overrides:
+        key, separator, value = override.partition('=')
+        if not separator:
+            raise ValueError('Expected KEY=VALUE: ' + override)
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+def run(transform, source, target, settings, report=None):
+    if transform == 'miso':
+        run_miso(source, target, settings, report)
+    elif transform == 'usage':
+        run_usage(source, target, settings, report)
+    else:
+        run_script(SCRIPTS[transform], source, target, settings, report)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Melt, ColorShift or Miso on a gcode file without Cura.')
+    parser.add_argument('transform', choices=sorted(list(SCRIPTS) + ['miso', 'usage']))
+    parser.add_argument('input', help='gcode file to process')
+    parser.add_argument('output', help='where to write the result, may be the input (usage writes JSON)')
+    parser.add_argument('--settings', help='JSON file of settings')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a single setting')
+    parser.add_argument('--report', metavar='JSON', help='write timings, counters and peak memory of the run to this file')
+    args = parser.parse_args(argv)
+    report = load_module('CoreLibrary').Instrumentation() if args.report else None
+    run(args.transform, args.input, args.output, read_settings(args.settings, args.set), report)
+    if report is not None:
+        report.write(args.report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
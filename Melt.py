@@ -30,7 +30,19 @@
 # gargansa, bass4aj, kenix, laraeb, datadink, keyreaper
 
 from ..Script import Script
-import random
+from .CoreLibrary import EditList, ExtrusionIndex, Instrumentation, LayerIndex, MixFilter, MixFormat
+from array import array
+import hashlib
+import json
+import math
+import os
+import re
+import tempfile
+
+try:
+    import numpy
+except ImportError:  # Batch planning falls back to the scalar modifiers
+    numpy = None
 
 
 # Convenience function for gargansa's coding familiarity
@@ -38,28 +50,18 @@ def clamp(value, minimum, maximum):
     return max(minimum, min(value, maximum))
 
 
-# Function to compile the initial setup into a string
-def initiate_extruder(existing_gcode, *gcode):
-    setup_line = ""
-    setup_line += existing_gcode
-    for line in gcode:
-        if line != str(""):
-            setup_line += "\n" + str(line) #+ "\n"
+# Function to compile extruder info into a gcode line
+def adjust_extruder_rate(*ext):
+    return MixFormat.join(ext)
 
-    return setup_line
 
+# Every line Melt inserts ends with this tag so a later run can find and replace it
+TAG = " ;Melt"
+tagged_lines = re.compile("^.* ;Melt$", re.M)
 
-# Function to compile extruder info into a string
-def adjust_extruder_rate(existing_gcode, *ext):
-    i = 0
-    for item in ext:
-        if i == 0:
-            setup_line = existing_gcode + "\nM567 P0 E" + str(item)
-        else:
-            setup_line += ":" + str(item)
-        i += 1
-    setup_line += "\n"
-    return setup_line
+
+def tag_lines(lines):
+    return [line + TAG for line in lines]
 
 
 # Just used to output info to text file to help debug
@@ -67,19 +69,62 @@ def print_debug(*report_data):
     setup_line = ";Debug "
     for item in report_data:
         setup_line += str(item)
-    setup_line += "\n"
     return setup_line
 
 
+# Function to set extruder values from user flows keeping the total at 1
+def set_flows(base_input, flows):
+    while len(flows) < len(base_input):  # Ensure at least as many are set as needed
+        flows.append(float(0))
+    total_value = 0
+    i = 0
+    for ext in base_input:  # Disregard extras
+        flows[i] = clamp(flows[i], 0, 1)  # Clamp to value range
+        if i == len(base_input)-1 and total_value < 1:  # Make the last one add up to 1
+            base_input[i] = 1 - total_value
+        elif flows[i] + total_value < 1:  # Keep within total of 1
+            base_input[i] = flows[i]
+        else:
+            base_input[i] = 1 - total_value
+        total_value += base_input[i]
+        i += 1
+
+
+# Function to format planned extruder ratios for a gcode line
+def format_ratios(ratios):
+    return MixFormat.ratios(ratios)
+
+
+# Function to format the ratios of every change in a schedule
+def format_schedule(schedule):
+    if numpy is not None and len(schedule):
+        matrix = numpy.array(schedule.ratios).reshape(len(schedule), schedule.qty_extruders)
+        return format_ratio_matrix(matrix).tolist()
+    return [format_ratios(schedule.mix(change)) for change in range(len(schedule))]
+
+
 class Melt(Script):
     version = "3.4.0"
 
+    # Set to an Instrumentation to time and count the next runs
+    # The last run's report is kept on self.report
+    instrumentation = None
+
+    # Planned schedules shared by every run in this process, see ScheduleCache
+    schedule_cache = None
+
+    # Declared settings keyed by name, read once, see setting_definitions
+    definitions = None
+
     def __init__(self):
         super().__init__()
+        self.report = Instrumentation.disabled()
 
-    def getSettingDataString(self):
+    # Static so the declared types can be read without a Cura script instance
+    @staticmethod
+    def getSettingDataString():
         return """{
-            "name":"Multi-Extruder Layering Tool """ + self.version + """ (MELT)",
+            "name":"Multi-Extruder Layering Tool """ + Melt.version + """ (MELT)",
             "key":"Melt",
             "metadata": {},
             "version": 2,
@@ -243,6 +288,23 @@ class Melt(Script):
                     "default_value": "0.5,1,0.25,0.75,0.5,0",
                     "enabled": "e_trigger == 'pattern'"
                 },
+                "random_seed":
+                {
+                    "label": "Random Seed",
+                    "description": "Seed for the Wood Texture and Random modifiers. The same seed always gives the same gcode, change it for a different texture.",
+                    "type": "int",
+                    "default_value": 0,
+                    "minimum_value": "0",
+                    "enabled": "e_trigger == 'wood' or e_trigger == 'random' or f_trigger == 'random'"
+                },
+                "segments":
+                {
+                    "label": "Gradient Segments",
+                    "description": "Several gradients planned in one run instead of running the script once per gradient. A JSON list with one object per segment, each holding the settings that differ for that segment (percent_change_start, percent_change_end, a_trigger, layer_change_start, layer_change_end, e_trigger, f_trigger, change_rate, ...) and optionally start_mix and end_mix to blend between two mixes like 1,0 and 0,1. Example: [{\\"percent_change_end\\": 50}, {\\"percent_change_start\\": 50, \\"start_mix\\": \\"0,1\\", \\"end_mix\\": \\"1,0\\"}]. Leave empty for a single gradient.",
+                    "type": "str",
+                    "default_value": "",
+                    "enabled": "e1_trigger"
+                },
                 "e1_trigger":
                 {
                     "label": "Expert Controls",
@@ -341,233 +403,683 @@ class Melt(Script):
                     "minimum_value_warning": "0",
                     "maximum_value_warning": "5",
                     "enabled": "e1_trigger"
+                },
+                "mixing_volume":
+                {
+                    "label": "Mixing Chamber Volume",
+                    "description": "Filament held between the mixing point and the nozzle. Each mix is written this much extrusion early so the new color reaches the nozzle at its layer. 0 writes mixes at their layer.",
+                    "unit": "mm³",
+                    "type": "float",
+                    "default_value": 0,
+                    "minimum_value": "0",
+                    "maximum_value_warning": "200",
+                    "enabled": "e1_trigger"
+                },
+                "filament_diameter":
+                {
+                    "label": "Filament Diameter",
+                    "description": "Used to turn the mixing chamber volume into a length of filament.",
+                    "unit": "mm",
+                    "type": "float",
+                    "default_value": 1.75,
+                    "minimum_value": "0.1",
+                    "enabled": "e1_trigger"
+                },
+                "debug_lines":
+                {
+                    "label": "Write Debug Lines",
+                    "description": "Write the settings used as ;Debug comments after ;LAYER_COUNT: to help troubleshoot user problems.",
+                    "type": "bool",
+                    "default_value": false,
+                    "enabled": "e1_trigger"
+                },
+                "reapply":
+                {
+                    "label": "Replace Earlier Run",
+                    "description": "Remove what an earlier run of Melt inserted and write the new mixes in its place instead of adding to them. Layers whose mixes did not change are left as they are.",
+                    "type": "bool",
+                    "default_value": false,
+                    "enabled": "e1_trigger"
+                },
+                "schedule_cache":
+                {
+                    "label": "Cache Planned Mixes",
+                    "description": "Keep planned mixes on disk so slicing again with the same settings and layer count skips planning.",
+                    "type": "bool",
+                    "default_value": true,
+                    "enabled": "e1_trigger"
                 }
             }
         }"""
 
+    # All user settings from cura keyed by setting name
+    def read_settings(self):
+        keys = json.loads(self.getSettingDataString())["settings"]
+        return dict((key, self.getSettingValueByKey(key)) for key in keys)
+
     def execute(self, data: list):  # used to be data: list
         # Set user settings from cura
-        clamp_choice = self.getSettingValueByKey("a_trigger")
-        direction = self.getSettingValueByKey("b_trigger")
-
-        # EVENTUALLY USED TO MAKE THE EXTRUDER LOOP BACK TO THE FIRST EXTRUDER
-        loop = self.getSettingValueByKey("c_trigger")  # linear or circular (not currently enabled)
-
-        modifier = self.getSettingValueByKey("e_trigger")  # normal, wood, pattern
-        rate_modifier = self.getSettingValueByKey("f_trigger")  # normal, random
-        change_rate = int(self.getSettingValueByKey("change_rate"))
-        initial_flows = [float(initial_flow) for initial_flow in self.getSettingValueByKey("initial_flow").strip().split(',')]
-        final_flows = [float(final_flow) for final_flow in self.getSettingValueByKey("final_flow").strip().split(',')]
-        flow_adjust = float((self.getSettingValueByKey("flow_adjust")) / 100) + 1  # convert user input into multi
-        qty_extruders = int(self.getSettingValueByKey("qty_extruders"))
-        flow_min = float(self.getSettingValueByKey("flow_min") / 100) * qty_extruders
-        flow_clamp_adjust = float(1 - (flow_min * qty_extruders))
-        pattern = [float(pattern) for pattern in self.getSettingValueByKey("pattern").strip().split(',')]
-        lerp_i = self.getSettingValueByKey("lerp_i")
-        slope_m = self.getSettingValueByKey("slope_m")
-        slope_i = self.getSettingValueByKey("slope_i")
-
-        enable_initial = self.getSettingValueByKey("enable_initial")
-        initial_a = self.getSettingValueByKey("initial_a")
-        initial_b = self.getSettingValueByKey("initial_b")
-        initial_c = self.getSettingValueByKey("initial_c")
-        initial_d = self.getSettingValueByKey("initial_d")
-        initial_e = self.getSettingValueByKey("initial_e")
-
-        # INITIATE EXTRUDERS AS ZERO EXCEPT FIRST ONE
-        base_input = [0] * qty_extruders
-        base_input[0] = 1
-
-        # CHECK ORDER OF VALUES ENTERED BY USER
-        percent_start = float(self.getSettingValueByKey("percent_change_start") / 100)
-        percent_end = float(self.getSettingValueByKey("percent_change_end") / 100)
-        layer_start = int(self.getSettingValueByKey("layer_change_start"))
-        layer_end = int(self.getSettingValueByKey("layer_change_end"))
-        # REORDER IF BACKWARDS
-        if percent_end < percent_start:
-            percent_start, percent_end = percent_end, percent_start
-        if layer_end < layer_start:
-            layer_start, layer_end = layer_end, layer_start
-
-        current_position = 0
-        end_position = 0
-        index = 0
-        has_been_run = 0
-
-        # Iterate through the layers
-        for active_layer in data:
-
-            # Remove the whitespace and split the gcode into lines
-            lines = active_layer.strip().split("\n")
-
-            modified_gcode = ""
-            for line in lines:
-                if ";Modified:" in line:
-                    has_been_run = 1
-                elif ";LAYER_COUNT:" in line:
-                    # FINDING THE ACTUAL AFFECTED LAYERS
-                    total_layers = float(line[(line.index(':') + 1): len(line)])
-
-                    # Calculate positions based on total_layers
-                    if clamp_choice == 'percent':
-                        start_position = int(int(total_layers) * float(percent_start))
-                        current_position = start_position
-                        end_position = int(int(total_layers) * float(percent_end))
-                    if clamp_choice == 'layer_no':
-                        start_position = int(clamp(layer_start, 0, total_layers))
-                        current_position = start_position
-                        end_position = int(clamp(layer_end, 0, total_layers))
-
-                    # how many layers are affected
-                    adjusted_layers = end_position - start_position
-
-                    # Make sure the change_rate doesnt sit outside of allowed values
-                    change_rate = int(clamp(change_rate, 0, adjusted_layers))
-
-                    # SETTING THE FLOWS SET BY USER IN EXPERT CONTROLS
-                    while len(initial_flows) < len(base_input):  # Ensure at least as many are set as needed
-                        initial_flows.append(float(0))
-                    total_value = 0
-                    i = 0
-                    for ext in base_input:  # Disregard extras
-                        initial_flows[i] = clamp(initial_flows[i], 0, 1)  # Clamp to value range
-                        if i == len(base_input)-1 and total_value < 1:  # Make the last one add up to 1
-                            base_input[i] = 1 - total_value
-                        elif initial_flows[i] + total_value < 1:  # Keep within total of 1
-                            base_input[i] = initial_flows[i]
-                        else:
-                            base_input[i] = 1 - total_value
-                        total_value += base_input[i]
-                        i += 1
-
-                    # ASSIGN THE INITIAL VALUES TO A SINGLE GCODE LINE
-                    ext_gcode_list = [''] * qty_extruders
-                    gcode_index = 0
-                    for code in ext_gcode_list:
-                        ext_gcode_list[ext_gcode_list.index(code)] = format(base_input[gcode_index] * flow_adjust * flow_clamp_adjust + flow_min, '.3f')
-                        gcode_index += 1
-
-                    modified_gcode += line  # list the initial line info
-
-                    if has_been_run == 0:
-                        if enable_initial:
-                            modified_gcode += initiate_extruder("", initial_a, initial_b, initial_c, initial_d, initial_e)
-                        if direction == 'normal':
-                            modified_gcode += adjust_extruder_rate("", *ext_gcode_list)
-                        else:
-                            modified_gcode += adjust_extruder_rate("", *ext_gcode_list[::-1])
-
-                    # DEBUG FOR USER REPORTING
-                    modified_gcode += print_debug("Version:", self.version)
-                    modified_gcode += print_debug("Clamp_choice:", clamp_choice, "  Direction:", direction)
-                    modified_gcode += print_debug("Modifier:", modifier, "  Rate Modifier:", rate_modifier)
-                    modified_gcode += print_debug("Pattern:", pattern)
-                    modified_gcode += print_debug("Change_rate:", change_rate, "  Initial_flows:", initial_flows, "  Final_flows", final_flows)
-                    modified_gcode += print_debug("Qty_extruders:", qty_extruders, "  Flow_min:", flow_min)
-                    modified_gcode += print_debug("Percent_start:", percent_start, "  Percent_end:", percent_end)
-                    modified_gcode += print_debug("Layer_start:", layer_start, "  Layer_end:", layer_end)
-
-
-                    # INITIATE VALUES USED THROUGH THE AFFECTED LAYERS
-                    if change_rate != 0:
-                        changes_total = int(adjusted_layers/change_rate)  # how many times are we allowed to adjust
-                    else:
-                        changes_total = 0
-
-                    #changes_per_extruder = int(changes_total/(qty_extruders-1))
-                    changes_per_extruder = int(changes_total/(qty_extruders-int(loop)))
-                    current_extruder = 0
-                    next_extruder = 1
-                    ext_fraction = changes_per_extruder
-
-                # CHANGES MADE TO LAYERS THROUGH THE AFFECTED LAYERS
-                elif ";LAYER:" + str(current_position) in line and int(current_position) < int(end_position):
-
-                    # ADJUST EXTRUDER RATES FOR NEXT AFFECTED LAYER 2 PARTS (should be simplified)
-                    # Part 1 adjust rate by fraction to avoid rounding errors from addition
-                    if modifier == 'normal':
-                        base_input[current_extruder], base_input[next_extruder] = standard_shift(ext_fraction, changes_per_extruder)
-                    elif modifier == 'wood':
-                        base_input[current_extruder], base_input[next_extruder] = wood_shift(0.05, 0.25)
-                    elif modifier == 'pattern':
-                        base_input[current_extruder], base_input[next_extruder] = pattern_shift(pattern)
-                    elif modifier == 'random':
-                        base_input[current_extruder], base_input[next_extruder] = random_shift()
-                    elif modifier == 'lerp':
-                        base_input[current_extruder], base_input[next_extruder] = lerp_shift(0, changes_per_extruder, ext_fraction/changes_per_extruder, lerp_i)
-                    elif modifier == 'slope':
-                        base_input[current_extruder], base_input[next_extruder] = lerp_shift(ext_fraction, changes_per_extruder, slope_m, slope_i)
-                    elif modifier == 'ellipse':
-                        base_input[current_extruder], base_input[next_extruder] = ellipse_shift(ext_fraction/changes_per_extruder)
-
-                    # Part 2 initialize what percentage to reach wrap extruders back to start if out of range
-                    ext_fraction -= 1
-                    if ext_fraction < 0:
-                        current_extruder += 1
-                        next_extruder += 1
-                        ext_fraction = changes_per_extruder-1  # -1 to avoid duplicate 0:1:0
-                    if next_extruder == qty_extruders:
-                        next_extruder = 0
-
-                    # lAST TWEAK ADJUST THE EXTRUDER VALUES BY FLOW ADJUSTMENTS AND LIMITS
-                    ext_gcode_list = [''] * qty_extruders
-                    gcode_index = 0
-                    for ext in ext_gcode_list:
-                        ext_gcode_list[ext_gcode_list.index(ext)] = format(base_input[gcode_index] * flow_adjust * flow_clamp_adjust + flow_min, '.3f')
-                        gcode_index += 1
-
-                    # TURN THE EXTRUDER VALUES INTO A SINGLE GCODE LINE
-                    if direction == 'normal':
-                        modified_gcode += adjust_extruder_rate(line, *ext_gcode_list)
-                    else:
-                        modified_gcode += adjust_extruder_rate(line, *ext_gcode_list[::-1])
-
-                    # CHANGE THE POSITION FOR NEXT RUN
-                    if rate_modifier == 'normal':
-                        current_position += standard_rate(change_rate)
-                    elif rate_modifier == 'random':
-                        current_position += random_rate(change_rate, change_rate*2)
-
-                # CHANGES MADE AFTER THE LAST AFFECTED LAYER TO COMPLETE THE PRINT WITH
-                elif ";LAYER:" + str(end_position) in line:  # Runs last and only runs once
-                    # SETTING THE FLOWS SET BY USER IN EXPERT CONTROLS
-                    while len(final_flows) < len(base_input):  # Ensure at least as many are set as needed
-                        final_flows.append(float(0))
-                    total_value = 0
-                    i = 0
-                    for ext in base_input:  # Disregard extras
-                        final_flows[i] = clamp(final_flows[i], 0, 1)  # Clamp to value range
-                        if i == len(base_input) - 1 and total_value < 1:  # Make the last one add up to 1
-                            base_input[i] = 1 - total_value
-                        elif final_flows[i] + total_value < 1:  # Keep within total of 1
-                            base_input[i] = final_flows[i]
-                        else:
-                            base_input[i] = 1 - total_value
-                        total_value += base_input[i]
-                        i += 1
-
-                    # ASSIGN THE INITIAL VALUES TO A SINGLE GCODE LINE
-                    ext_gcode_list = [''] * qty_extruders
-                    gcode_index = 0
-                    for code in ext_gcode_list:
-                        ext_gcode_list[ext_gcode_list.index(code)] = format(base_input[gcode_index] * flow_adjust * flow_clamp_adjust + flow_min, '.3f')
-                        gcode_index += 1
-
-                    # change direction of shift if set by user
-                    if direction == 'normal':
-                        modified_gcode += adjust_extruder_rate(line, *ext_gcode_list)
-                    else:
-                        modified_gcode += adjust_extruder_rate(line, *ext_gcode_list[::-1])
-
-                # LEAVE ALL OTHER LINES ALONE SINCE THEY ARE NOT NEW LAYERS
-                else:
-                    modified_gcode += line + "\n"
-
-            # REPLACE THE DATA
-            data[index] = modified_gcode
-            index += 1
+        settings = self.read_settings()
+        report = self.report = self.instrumentation or Instrumentation.disabled()
+        report.start()
+
+        # Find the layers to modify without scanning every line
+        with report.phase("parse"):
+            layer_index = LayerIndex(data)
+            total_layers = layer_index.layerCount()
+        if report.enabled:
+            report.count("lines_scanned", sum(chunk.count("\n") + 1 for chunk in data))
+        if total_layers is None:
+            report.stop()
+            return data
+
+        # Decide every mix up front then write them into the gcode
+        # Every gradient segment is planned first so the gcode is only edited once
+        with report.phase("plan"):
+            schedule = self.plan(settings, total_layers, report)
+        with report.phase("emit"):
+            data = self.emit_schedule(data, layer_index, schedule, settings, report)
+
+        # Drop mixes that repeat the active one or are replaced before use,
+        # which earlier runs of the script and repeating modifiers leave behind
+        with report.phase("optimize"):
+            report.count("m567_removed", MixFilter().apply(data))
+        report.set("version", self.version)
+        report.set("settings", settings)
+        report.set("total_layers", total_layers)
+        report.set("schedule", schedule.report)
+        report.stop()
         return data
 
+    # Planned schedule for the settings, from the schedule cache when it has one
+    def plan(self, settings, total_layers, report=Instrumentation.disabled()):
+        if not settings["schedule_cache"]:
+            return plan_segments(settings, total_layers)
+        if Melt.schedule_cache is None:
+            Melt.schedule_cache = ScheduleCache()
+        cache = Melt.schedule_cache
+        key = cache.key(settings, total_layers, self.version)
+        schedule = cache.get(key)
+        if schedule is not None:
+            report.count("cache_hits")
+            return schedule
+        report.count("cache_misses")
+        schedule = plan_segments(settings, total_layers)
+        cache.put(key, schedule)
+        return schedule
+
+    # Writes a planned schedule into the layers it affects
+    # Changes are recorded and applied to the modified layers at the end
+    def emit_schedule(self, data, layer_index, schedule, settings, report=Instrumentation.disabled()):
+        edits = EditList()
+        count_position = layer_index.marker("LAYER_COUNT")[:2]
+
+        # Setup is skipped if an earlier run already modified the header
+        # unless that run is being replaced
+        modified = layer_index.find(";Modified:")
+        has_been_run = not settings["reapply"] and modified is not None and modified < count_position
+
+        setup_lines = []
+        if not has_been_run:
+            if settings["enable_initial"]:
+                initial_lines = (settings["initial_a"], settings["initial_b"], settings["initial_c"], settings["initial_d"], settings["initial_e"])
+                setup_lines += [str(line) for line in initial_lines if line != str("")]
+            setup_lines.append(adjust_extruder_rate(*format_ratios(schedule.initial)))
+            report.count("m567_emitted")
+
+        # DEBUG FOR USER REPORTING
+        # Only written when asked for, the same values are in the instrumentation report
+        if settings["debug_lines"]:
+            plan = schedule.report
+            setup_lines.append(print_debug("Version:", self.version))
+            setup_lines.append(print_debug("Clamp_choice:", settings["a_trigger"], "  Direction:", settings["b_trigger"]))
+            setup_lines.append(print_debug("Modifier:", settings["e_trigger"], "  Rate Modifier:", settings["f_trigger"]))
+            setup_lines.append(print_debug("Pattern:", plan["pattern"]))
+            setup_lines.append(print_debug("Change_rate:", plan["change_rate"], "  Initial_flows:", plan["initial_flows"], "  Final_flows", plan["final_flows"]))
+            setup_lines.append(print_debug("Qty_extruders:", schedule.qty_extruders, "  Flow_min:", plan["flow_min"]))
+            setup_lines.append(print_debug("Percent_start:", plan["percent_start"], "  Percent_end:", plan["percent_end"]))
+            setup_lines.append(print_debug("Layer_start:", plan["layer_start"], "  Layer_end:", plan["layer_end"]))
+            if settings["schedule_cache"] and Melt.schedule_cache is not None:
+                stats = Melt.schedule_cache.stats()
+                setup_lines.append(print_debug("Schedule_cache_hits:", stats["hits"], "  Misses:", stats["misses"], "  Entries:", stats["entries"], "/", stats["size"]))
+        if setup_lines:
+            edits.insertAfter(count_position, tag_lines(setup_lines))
+
+        # Mark the header so later runs and batch tools know the file was modified
+        if not has_been_run:
+            edits.insertBefore(count_position, tag_lines([";Modified: Melt " + self.version]))
+
+        # With a mixing chamber each change is written early by the chamber's
+        # length of filament, found in a running total of the extrusion,
+        # but never before ;LAYER_COUNT: and the setup lines after it (this run's
+        # or an earlier run's tagged ones), the tool is only defined there
+        mixing_length = 0
+        if settings["mixing_volume"] > 0:
+            mixing_length = ExtrusionIndex.length(settings["mixing_volume"], settings["filament_diameter"])
+            extrusion = ExtrusionIndex(data)
+            count_chunk, count_line = count_position
+            count_lines = data[count_chunk].split("\n")
+            earliest = count_line + 1
+            while earliest < len(count_lines) - 1 and count_lines[earliest].endswith(TAG):
+                earliest += 1
+            earliest = (count_chunk, earliest)
+
+        def insert_mix(layer_position, ratios):
+            early = extrusion.before(layer_position, mixing_length) if mixing_length else None
+            if early is not None and early < earliest:
+                early = earliest
+                report.count("m567_clamped")
+            if early is None:
+                edits.insertAfter(layer_position, tag_lines([adjust_extruder_rate(*ratios)]))
+            else:
+                edits.insertBefore(early, tag_lines([adjust_extruder_rate(*ratios)]))
+                report.count("m567_shifted")
+            report.count("m567_emitted")
+            report.count("layers_modified")
+
+        # CHANGES MADE TO LAYERS THROUGH THE AFFECTED LAYERS
+        for change, ratios in enumerate(format_schedule(schedule)):
+            layer_position = layer_index.layer(schedule.layers[change])
+            if layer_position is not None:
+                insert_mix(layer_position, ratios)
+
+        # CHANGES MADE AFTER THE LAST AFFECTED LAYER TO COMPLETE THE PRINT WITH
+        layer_position = layer_index.layer(schedule.end_layer)
+        if layer_position is not None:
+            insert_mix(layer_position, format_ratios(schedule.final))
+
+        if settings["reapply"]:
+            replace_tagged_lines(data, edits, report)
+        return edits.apply(data)
+
+
+# Turns the edits of a new run into edits that replace an earlier run
+# The tagged lines already in each chunk are compared with the lines the new
+# run adds there: a chunk where they match is left untouched, otherwise the
+# old tagged lines are deleted and the new ones written
+def replace_tagged_lines(data, edits, report=Instrumentation.disabled()):
+    tagged = {}
+    for chunk, gcode in enumerate(data):
+        if TAG not in gcode:
+            continue
+        found = []
+        line = 0
+        last = 0
+        for match in tagged_lines.finditer(gcode):
+            line += gcode.count("\n", last, match.start())
+            last = match.start()
+            found.append((line, match.group(0)))
+        if found:
+            tagged[chunk] = found
+    for chunk in sorted(set(tagged) | set(edits.chunks)):
+        old = tagged.get(chunk, [])
+        if [text for line, text in old] == edits.insertedLines(chunk):
+            edits.discard(chunk)
+            report.count("layers_unchanged")
+            continue
+        for line, text in old:
+            edits.delete((chunk, line))
+        report.count("layers_replaced")
+
+
+# PLANNED EXTRUDER MIXES
+# Every mix a run will write, decided before any gcode is touched
+# initial is set at ;LAYER_COUNT:, each change at its layer and final at end_layer
+# Ratios are flow adjusted and already in the order they are written (direction applied)
+# layers and ratios are flat arrays, change n uses ratios[n*qty_extruders:(n+1)*qty_extruders]
+class MixSchedule:
+    def __init__(self, qty_extruders):
+        self.qty_extruders = qty_extruders
+        self.initial = array('d')
+        self.layers = array('l')
+        self.ratios = array('d')
+        self.end_layer = 0
+        self.final = array('d')
+        self.report = {}
+
+    def __len__(self):
+        return len(self.layers)
+
+    def add(self, layer, ratios):
+        self.layers.append(layer)
+        self.ratios.extend(ratios)
+
+    def mix(self, change):
+        return self.ratios[change * self.qty_extruders:(change + 1) * self.qty_extruders]
+
+    def to_dict(self):
+        return {"qty_extruders": self.qty_extruders, "initial": self.initial.tolist(), "layers": self.layers.tolist(),
+                "ratios": self.ratios.tolist(), "end_layer": self.end_layer, "final": self.final.tolist(),
+                "report": self.report}
+
+    @staticmethod
+    def from_dict(values):
+        schedule = MixSchedule(values["qty_extruders"])
+        schedule.initial.extend(values["initial"])
+        schedule.layers.extend(values["layers"])
+        schedule.ratios.extend(values["ratios"])
+        schedule.end_layer = values["end_layer"]
+        schedule.final.extend(values["final"])
+        schedule.report = values["report"]
+        return schedule
+
+
+# PLANNED SCHEDULES KEPT BETWEEN RUNS
+# One JSON file per schedule, named by a hash of everything planning reads
+# (the planning settings, the layer count, the extruder count and the version)
+# Reading a schedule touches its file, past size files the least recently used go
+# A cache that cannot be read or written is treated as empty
+class ScheduleCache:
+    # Settings only used when writing the gcode, they do not change the plan
+    emit_settings = ("firmware_type", "e1_trigger", "enable_initial", "initial_a", "initial_b", "initial_c",
+                     "initial_d", "initial_e", "debug_lines", "reapply", "schedule_cache", "mixing_volume",
+                     "filament_diameter")
+
+    def __init__(self, directory=None, size=64):
+        self.directory = directory or os.environ.get("MELT_SCHEDULE_CACHE") or \
+            os.path.join(tempfile.gettempdir(), "melt_schedule_cache")
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, settings, total_layers, version):
+        planned = dict((key, value) for key, value in settings.items() if key not in ScheduleCache.emit_settings)
+        text = json.dumps([version, total_layers, settings["qty_extruders"], planned], sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as source:
+                schedule = MixSchedule.from_dict(json.load(source))
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return schedule
+
+    def put(self, key, schedule):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            handle, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, "w") as output:
+                json.dump(schedule.to_dict(), output)
+            os.replace(temp, self.path(key))
+        except (OSError, TypeError, ValueError):
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        self.evict()
+
+    def entries(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names]
+
+    # Other processes may evict at the same time, files already gone are skipped
+    def evict(self):
+        entries = self.entries()
+        if len(entries) <= self.size:
+            return
+        used = []
+        for path in entries:
+            try:
+                used.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        used.sort()
+        for mtime, path in used[:len(used) - self.size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries()), "size": self.size}
+
+
+# Segment keys that are not Melt settings
+SEGMENT_MIXES = ("start_mix", "end_mix")
+# String settings holding comma separated numbers
+NUMBER_LISTS = ("pattern", "initial_flow", "final_flow") + SEGMENT_MIXES
+
+
+# Type and options of every Melt setting, from getSettingDataString
+def setting_definitions():
+    if Melt.definitions is None:
+        Melt.definitions = json.loads(Melt.getSettingDataString())["settings"]
+    return Melt.definitions
+
+
+# A finite number from a JSON number or a numeric string
+def segment_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("must be a number, not %s" % json.dumps(value))
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("must be a number, not %s" % json.dumps(value))
+    if not math.isfinite(number):
+        raise ValueError("must be a finite number, not %s" % json.dumps(value))
+    return number
+
+
+# A segment value converted to the type its setting declares, the way Cura
+# would convert it, ValueError when it cannot be
+def segment_value(key, value):
+    if key in NUMBER_LISTS:
+        parts = value if isinstance(value, list) else str(value).split(",")
+        return ",".join(str(segment_number(part)) for part in parts)
+    definition = setting_definitions()[key]
+    kind = definition["type"]
+    if kind == "float":
+        return segment_number(value)
+    if kind == "int":
+        return int(segment_number(value))
+    if kind == "bool":
+        if not isinstance(value, bool):
+            raise ValueError("must be true or false, not %s" % json.dumps(value))
+        return value
+    if kind == "enum":
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and float(value).is_integer():
+            value = str(int(value))
+        if value not in definition["options"]:
+            raise ValueError("must be one of %s, not %s" % (", ".join(definition["options"]), json.dumps(value)))
+        return value
+    if not isinstance(value, str):
+        raise ValueError("must be a string, not %s" % json.dumps(value))
+    return value
+
+
+# Reads the gradient segments setting, a JSON list of setting overrides
+# Each value is checked and converted to its setting's type, errors name
+# the segment by its position in the list
+def parse_segments(settings):
+    text = settings["segments"]
+    if not text or not text.strip():
+        return []
+    segments = json.loads(text)
+    if not isinstance(segments, list) or not all(isinstance(segment, dict) for segment in segments):
+        raise ValueError("Gradient segments must be a JSON list of objects")
+    for number, segment in enumerate(segments, 1):
+        written = json.dumps(segment)
+        for key, value in segment.items():
+            if key not in settings and key not in SEGMENT_MIXES:
+                raise ValueError("Unknown gradient segment setting: " + key)
+            try:
+                segment[key] = segment_value(key, value)
+            except ValueError as error:
+                raise ValueError("Gradient segment %d %s: %s %s" % (number, written, key, error))
+    return segments
+
+
+# Plans every gradient segment and merges them into one schedule
+# Each segment's final mix becomes a change at its end layer, the next
+# segment's changes follow it so a later segment wins on a shared layer
+# Without segments this is plan_schedule for the settings as they are
+def plan_segments(settings, total_layers, vectorize=True):
+    segments = parse_segments(settings)
+    if not segments:
+        return plan_schedule(settings, total_layers, vectorize)
+    planned = []
+    for segment in segments:
+        segment_settings = dict(settings)
+        segment_settings.update(segment)
+        if "start_mix" in segment or "end_mix" in segment:
+            planned.append(plan_blend(segment_settings, total_layers, vectorize))
+        else:
+            planned.append(plan_schedule(segment_settings, total_layers, vectorize))
+
+    schedule = MixSchedule(planned[0].qty_extruders)
+    schedule.initial.extend(planned[0].initial)
+    changes = []
+    for order, part in enumerate(planned):
+        changes += [(part.layers[change], order, part.mix(change)) for change in range(len(part))]
+        if order < len(planned) - 1:
+            changes.append((part.end_layer, order, part.final))
+    for layer, order, ratios in sorted(changes, key=lambda change: change[:2]):
+        schedule.add(layer, ratios)
+    schedule.end_layer = planned[-1].end_layer
+    schedule.final.extend(planned[-1].final)
+    schedule.report = dict(planned[0].report)
+    schedule.report["segments"] = len(planned)
+    return schedule
+
+
+# Plans a segment that blends from start_mix to end_mix
+# The modifiers run on two stand in extruders, each planned pair (a, b) then
+# gives the mix a*start_mix + b*end_mix before the flow adjustments
+def plan_blend(settings, total_layers, vectorize=True):
+    qty_extruders = int(settings["qty_extruders"])
+    mixes = []
+    for key, default in (("start_mix", "1"), ("end_mix", "0,1")):
+        mix = [0] * qty_extruders
+        set_flows(mix, [float(flow) for flow in str(settings.get(key, default)).strip().split(',')])
+        mixes.append(mix)
+    start_mix, end_mix = mixes
+
+    pairs = dict(settings, qty_extruders="2", c_trigger="1", b_trigger="normal", flow_adjust=0, flow_min=0,
+                 initial_flow="1,0", final_flow="0,1")
+    planned = plan_schedule(pairs, total_layers, vectorize)
+
+    flow_adjust = float((settings["flow_adjust"]) / 100) + 1
+    flow_min = float(settings["flow_min"] / 100) * qty_extruders
+    flow_clamp_adjust = float(1 - (flow_min * qty_extruders))
+
+    def blend(pair):
+        ratios = [(pair[0] * start + pair[1] * end) * flow_adjust * flow_clamp_adjust + flow_min
+                  for start, end in zip(start_mix, end_mix)]
+        return ratios if settings["b_trigger"] == 'normal' else ratios[::-1]
+
+    schedule = MixSchedule(qty_extruders)
+    schedule.initial.extend(blend(planned.initial))
+    for change in range(len(planned)):
+        schedule.add(planned.layers[change], blend(planned.mix(change)))
+    schedule.end_layer = planned.end_layer
+    schedule.final.extend(blend(planned.final))
+    schedule.report = dict(planned.report, start_mix=start_mix, end_mix=end_mix, flow_min=flow_min)
+    return schedule
+
+
+# Works out the whole schedule of mixes from the user settings and layer count
+# vectorize uses the numpy batch modifiers when they give the same result
+def plan_schedule(settings, total_layers, vectorize=True):
+    clamp_choice = settings["a_trigger"]
+    direction = settings["b_trigger"]
+
+    # EVENTUALLY USED TO MAKE THE EXTRUDER LOOP BACK TO THE FIRST EXTRUDER
+    loop = settings["c_trigger"]  # linear or circular (not currently enabled)
+
+    modifier = settings["e_trigger"]  # normal, wood, pattern
+    rate_modifier = settings["f_trigger"]  # normal, random
+    change_rate = int(settings["change_rate"])
+    initial_flows = [float(initial_flow) for initial_flow in settings["initial_flow"].strip().split(',')]
+    final_flows = [float(final_flow) for final_flow in settings["final_flow"].strip().split(',')]
+    flow_adjust = float((settings["flow_adjust"]) / 100) + 1  # convert user input into multi
+    qty_extruders = int(settings["qty_extruders"])
+    flow_min = float(settings["flow_min"] / 100) * qty_extruders
+    flow_clamp_adjust = float(1 - (flow_min * qty_extruders))
+    pattern = [float(pattern) for pattern in settings["pattern"].strip().split(',')]
+    seed = int(settings["random_seed"])
+    lerp_i = settings["lerp_i"]
+    slope_m = settings["slope_m"]
+    slope_i = settings["slope_i"]
+
+    # INITIATE EXTRUDERS AS ZERO EXCEPT FIRST ONE
+    base_input = [0] * qty_extruders
+    base_input[0] = 1
+
+    # CHECK ORDER OF VALUES ENTERED BY USER
+    percent_start = float(settings["percent_change_start"] / 100)
+    percent_end = float(settings["percent_change_end"] / 100)
+    layer_start = int(settings["layer_change_start"])
+    layer_end = int(settings["layer_change_end"])
+    # REORDER IF BACKWARDS
+    if percent_end < percent_start:
+        percent_start, percent_end = percent_end, percent_start
+    if layer_end < layer_start:
+        layer_start, layer_end = layer_end, layer_start
+
+    schedule = MixSchedule(qty_extruders)
+    schedule.report = {"pattern": list(pattern), "final_flows": list(final_flows), "flow_min": flow_min,
+                       "percent_start": percent_start, "percent_end": percent_end,
+                       "layer_start": layer_start, "layer_end": layer_end}
+
+    # Ratios are stored in the order they are written
+    def add_ratios(values):
+        ratios = [ext * flow_adjust * flow_clamp_adjust + flow_min for ext in values]
+        return ratios if direction == 'normal' else ratios[::-1]
+
+    # FINDING THE ACTUAL AFFECTED LAYERS
+    total_layers = float(total_layers)
+
+    # Calculate positions based on total_layers
+    if clamp_choice == 'percent':
+        start_position = int(int(total_layers) * float(percent_start))
+        end_position = int(int(total_layers) * float(percent_end))
+    else:
+        start_position = int(clamp(layer_start, 0, total_layers))
+        end_position = int(clamp(layer_end, 0, total_layers))
+    current_position = start_position
+
+    # how many layers are affected
+    adjusted_layers = end_position - start_position
+
+    # Make sure the change_rate doesnt sit outside of allowed values
+    change_rate = int(clamp(change_rate, 0, adjusted_layers))
+
+    # SETTING THE FLOWS SET BY USER IN EXPERT CONTROLS
+    set_flows(base_input, initial_flows)
+    schedule.initial.extend(add_ratios(base_input))
+    schedule.report["change_rate"] = change_rate
+    schedule.report["initial_flows"] = list(initial_flows)
+
+    # INITIATE VALUES USED THROUGH THE AFFECTED LAYERS
+    if change_rate != 0:
+        changes_total = int(adjusted_layers/change_rate)  # how many times are we allowed to adjust
+    else:
+        changes_total = 0
+
+    #changes_per_extruder = int(changes_total/(qty_extruders-1))
+    changes_per_extruder = int(changes_total/(qty_extruders-int(loop)))
+    current_extruder = 0
+    next_extruder = 1
+    ext_fraction = changes_per_extruder
+
+    # CHANGES MADE TO LAYERS THROUGH THE AFFECTED LAYERS
+    # A change rate of 0 only sets the initial rate
+    positions = None
+    if vectorize and numpy is not None and change_rate != 0 and changes_per_extruder > 0:
+        if rate_modifier == 'normal':
+            positions = list(range(current_position, end_position, standard_rate(change_rate)))
+        elif rate_modifier == 'random':
+            positions = []
+            while current_position < end_position:
+                positions.append(current_position)
+                current_position += random_rate(change_rate, change_rate*2, counter_random(seed, current_position, RATE_DRAWS))
+        if not batch_supported(modifier, len(positions), changes_per_extruder, qty_extruders):
+            current_position = start_position  # let the scalar loop redo the same draws
+            positions = None
+    if positions is not None:
+        matrix = plan_ratios_batch(base_input, positions, changes_per_extruder, modifier, pattern, seed,
+                                   flow_adjust, flow_clamp_adjust, flow_min)
+        if direction != 'normal':
+            matrix = matrix[:, ::-1]
+        schedule.layers.extend(positions)
+        schedule.ratios.extend(matrix.ravel().tolist())
+    else:
+        while change_rate != 0 and current_position < end_position:
+
+            # ADJUST EXTRUDER RATES FOR NEXT AFFECTED LAYER 2 PARTS (should be simplified)
+            # Part 1 adjust rate by fraction to avoid rounding errors from addition
+            if modifier == 'normal':
+                base_input[current_extruder], base_input[next_extruder] = standard_shift(ext_fraction, changes_per_extruder)
+            elif modifier == 'wood':
+                base_input[current_extruder], base_input[next_extruder] = wood_shift(0.05, 0.25, counter_random(seed, current_position, SHIFT_DRAWS))
+            elif modifier == 'pattern':
+                base_input[current_extruder], base_input[next_extruder] = pattern_shift(pattern)
+            elif modifier == 'random':
+                base_input[current_extruder], base_input[next_extruder] = random_shift(counter_random(seed, current_position, SHIFT_DRAWS))
+            elif modifier == 'lerp':
+                base_input[current_extruder], base_input[next_extruder] = lerp_shift(0, changes_per_extruder, ext_fraction/changes_per_extruder, lerp_i)
+            elif modifier == 'slope':
+                base_input[current_extruder], base_input[next_extruder] = lerp_shift(ext_fraction, changes_per_extruder, slope_m, slope_i)
+            elif modifier == 'ellipse':
+                base_input[current_extruder], base_input[next_extruder] = ellipse_shift(ext_fraction/changes_per_extruder)
+
+            # Part 2 initialize what percentage to reach wrap extruders back to start if out of range
+            ext_fraction -= 1
+            if ext_fraction < 0:
+                current_extruder += 1
+                next_extruder += 1
+                ext_fraction = changes_per_extruder-1  # -1 to avoid duplicate 0:1:0
+            if next_extruder == qty_extruders:
+                next_extruder = 0
+
+            # lAST TWEAK ADJUST THE EXTRUDER VALUES BY FLOW ADJUSTMENTS AND LIMITS
+            schedule.add(current_position, add_ratios(base_input))
+
+            # CHANGE THE POSITION FOR NEXT RUN
+            if rate_modifier == 'normal':
+                current_position += standard_rate(change_rate)
+            elif rate_modifier == 'random':
+                current_position += random_rate(change_rate, change_rate*2, counter_random(seed, current_position, RATE_DRAWS))
+
+    # CHANGES MADE AFTER THE LAST AFFECTED LAYER TO COMPLETE THE PRINT WITH
+    set_flows(base_input, final_flows)
+    schedule.end_layer = end_position
+    schedule.final.extend(add_ratios(base_input))
+    return schedule
+
+
+# RANDOM DRAWS FOR THE WOOD AND RANDOM MODIFIERS
+# Counter based so each draw only depends on (seed, layer, kind of draw)
+# Layers can be planned in any order or in parallel and re-slicing gives the same gcode
+SHIFT_DRAWS = 1
+RATE_DRAWS = 2
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+# splitmix64 finalizer, scrambles a 64 bit counter into a random looking value
+def mix_64(value):
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+# Random value between 0 and 1 for one layer
+def counter_random(seed, layer, draws):
+    key = mix_64(seed * 4 + draws)
+    return (mix_64((key + layer) & MASK_64) >> 11) / 9007199254740992.0  # 53 bits
+
+
+# Same as counter_random for an array of layers
+def counter_random_batch(seed, layers, draws):
+    key = numpy.uint64(mix_64(seed * 4 + draws))
+    value = numpy.asarray(layers, dtype=numpy.int64).view(numpy.uint64) + key
+    value = value + numpy.uint64(0x9E3779B97F4A7C15)
+    value = (value ^ (value >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    value = (value ^ (value >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    value = value ^ (value >> numpy.uint64(31))
+    return (value >> numpy.uint64(11)).astype(float) / 9007199254740992.0
+
 
 # MODIFIERS FOR DIFFERENT EFFECTS ON EXTRUDERS
 # SHIFTS AFFECT EXTRUDER RATIOS AND RETURN BOTH VALUES TOGETHER (X AND 1-X)
@@ -575,8 +1087,8 @@ def standard_shift(numerator, denominator):
     return numerator/denominator, (denominator-numerator)/denominator
 
 
-def wood_shift(min_percentage, max_percentage):
-    random_value = random.uniform(min_percentage, max_percentage)
+def wood_shift(min_percentage, max_percentage, draw):
+    random_value = min_percentage + (max_percentage-min_percentage) * draw
     return random_value, 1-random_value
 
 
@@ -586,8 +1098,8 @@ def pattern_shift(list):
     return value, 1-value
 
 
-def random_shift():
-    random_value = random.uniform(0, 1)
+def random_shift(draw):
+    random_value = draw
     return random_value, 1-random_value
 
 
@@ -607,7 +1119,7 @@ def lerp_shift(v0, v1, t, i):
 def ellipse_shift(x):
     y = 4 - ((0.12*x*x) + (1.12 * x) + 2.78)
     y = clamp(y, 0, 1)
-    y = pow(y, 0.5)
+    y = math.sqrt(y)
     y = clamp(y, 0, 1)  # This is unnecessary but here just as an in case.
     return 1-y, y
 
@@ -617,10 +1129,118 @@ def standard_rate(rate):
     return rate
 
 
-def random_rate(min_percentage, max_percentage):
-    random_value = int(random.uniform(min_percentage, max_percentage))
+def random_rate(min_percentage, max_percentage, draw):
+    random_value = int(min_percentage + (max_percentage-min_percentage) * draw)
     return random_value
 
 
+# BATCH MODIFIERS (NUMPY)
+# Same effects as the scalar modifiers above but for every change at once
+# The scalar functions stay the reference, these return identical values as arrays
+def standard_shift_batch(numerators, denominator):
+    numerators = numpy.asarray(numerators, dtype=float)
+    return numerators/denominator, (denominator-numerators)/denominator
+
+
+def wood_shift_batch(min_percentage, max_percentage, draws):
+    random_values = min_percentage + (max_percentage-min_percentage) * draws
+    return random_values, 1-random_values
+
+
+def pattern_shift_batch(list, count):
+    values = numpy.asarray(list, dtype=float)[(-1 - numpy.arange(count)) % len(list)]
+    rotate = count % len(list)  # leave the list as count calls of pattern_shift would
+    list[:] = list[len(list)-rotate:] + list[:len(list)-rotate]
+    return values, 1-values
+
+
+def random_shift_batch(draws):
+    random_values = numpy.asarray(draws, dtype=float)
+    return random_values, 1-random_values
+
+
+def slope_shift_batch(x_numerators, x_denomerator, m_slope, y_intercept):
+    y = (m_slope*numpy.asarray(x_numerators, dtype=float)/x_denomerator)+y_intercept
+    y = numpy.clip(y, 0, 1)
+    return 1-y, y
+
+
+def lerp_shift_batch(count):
+    answer = numpy.ones(count)
+    return 1-answer, answer
+
+
+def ellipse_shift_batch(x):
+    x = numpy.asarray(x, dtype=float)
+    y = 4 - ((0.12*x*x) + (1.12 * x) + 2.78)
+    y = numpy.clip(y, 0, 1)
+    y = numpy.sqrt(y)
+    y = numpy.clip(y, 0, 1)
+    return 1-y, y
 
 
+# Whether plan_ratios_batch can stand in for the scalar loop
+# Anything the scalar loop would fail on is left to it so the error is the same
+def batch_supported(modifier, count, changes_per_extruder, qty_extruders):
+    if modifier not in ('normal', 'wood', 'pattern', 'random', 'lerp', 'slope', 'ellipse'):
+        return False
+    last_pair = 0 if count <= changes_per_extruder + 1 else 1 + (count - changes_per_extruder - 2) // changes_per_extruder
+    return last_pair < qty_extruders
+
+
+# Works out the ratios of the changes at every layer in positions at once
+# base_input holds the extruder values before the first change
+# Returns a (changes x extruders) matrix with flow adjustments and limits applied
+def plan_ratios_batch(base_input, positions, changes_per_extruder, modifier, pattern, seed, flow_adjust, flow_clamp_adjust, flow_min):
+    qty_extruders = len(base_input)
+    count = len(positions)
+    changes = numpy.arange(count)
+
+    # Which extruder pair each change shifts and the fraction it uses
+    # The first pair gets one extra change to reach both ends
+    later = changes - changes_per_extruder - 1
+    first = later < 0
+    pair = numpy.where(first, 0, 1 + later // changes_per_extruder)
+    ext_fraction = numpy.where(first, changes_per_extruder - changes, changes_per_extruder - 1 - later % changes_per_extruder)
+    current_extruder = pair
+    next_extruder = (pair + 1) % qty_extruders
+
+    if modifier == 'normal':
+        first_values, next_values = standard_shift_batch(ext_fraction, changes_per_extruder)
+    elif modifier == 'wood':
+        first_values, next_values = wood_shift_batch(0.05, 0.25, counter_random_batch(seed, positions, SHIFT_DRAWS))
+    elif modifier == 'pattern':
+        first_values, next_values = pattern_shift_batch(pattern, count)
+    elif modifier == 'random':
+        first_values, next_values = random_shift_batch(counter_random_batch(seed, positions, SHIFT_DRAWS))
+    elif modifier == 'ellipse':
+        first_values, next_values = ellipse_shift_batch(ext_fraction/changes_per_extruder)
+    else:  # lerp and slope both use lerp_shift
+        first_values, next_values = lerp_shift_batch(count)
+
+    # Extruders keep their last value until a change sets them again
+    matrix = numpy.full((count, qty_extruders), numpy.nan)
+    matrix[changes, current_extruder] = first_values
+    matrix[changes, next_extruder] = next_values
+    last_set = numpy.where(numpy.isnan(matrix), -1, changes[:, None])
+    last_set = numpy.maximum.accumulate(last_set, axis=0)
+    carried = matrix[numpy.maximum(last_set, 0), numpy.arange(qty_extruders)]
+    matrix = numpy.where(last_set >= 0, carried, numpy.asarray(base_input, dtype=float))
+
+    return matrix * flow_adjust * flow_clamp_adjust + flow_min
+
+
+# Formats a (changes x extruders) ratio matrix into .3f strings in one call
+# Ratios are looked up in the MixFormat table, the few it cannot round
+# safely are formatted, NaN and infinite ones raise like MixFormat.ratios
+def format_ratio_matrix(matrix):
+    finite = numpy.isfinite(matrix)
+    if not finite.all():
+        raise ValueError('Mix ratio must be a finite number, not %r' % float(matrix[~finite][0]))
+    scaled = matrix * 1000
+    steps = numpy.floor(scaled + 0.5)
+    safe = (scaled >= 0) & (steps <= 1000) & (numpy.abs(scaled - steps) < 0.499999)
+    formatted = numpy.array(MixFormat.table, dtype='<U16')[numpy.where(safe, steps, 0).astype(int)]
+    if not safe.all():
+        formatted[~safe] = numpy.char.mod('%.3f', matrix[~safe])
+    return formatted
@@ -0,0 +1,337 @@
+################################################################################
+#
+# MELT Duet Upload
+#
+# Runs Melt, ColorShift or Miso on a gcode file and streams the result into a
+# Duet board's HTTP upload (rr_upload) while it is being produced, instead of
+# writing a file and uploading it afterwards.
+#
+# The transform runs in a worker thread and hands its output to the upload
+# through a bounded queue, so the CPU work and the network transfer overlap
+# and a slow board holds the transform back instead of the output piling up
+# in memory. Everything sent is also spooled to a temporary file: when the
+# streamed upload fails the spool is sent again, with its length and CRC32,
+# up to --retries more times with a doubling delay.
+#
+# The streamed attempt uses chunked transfer encoding since the length is not
+# known yet. A board that refuses it (411 Length Required) is sent the spool
+# as soon as the transform has finished.
+#
+# DuetMock.py is a local stand in for the board, to try this without a printer.
+#
+# Usage:
+#   python Upload.py melt input.gcode http://duet.local --settings melt.json
+#   python Upload.py miso input.gcode http://192.168.1.20 --name 0:/gcodes/vase.gcode --password secret
+#   python DuetMock.py --port 8080 --directory received &
+#   python Upload.py melt input.gcode http://127.0.0.1:8080 --report upload.json
+#
+################################################################################
+
+import argparse
+import asyncio
+import binascii
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import Headless
+
+# Pieces (layer chunks) waiting for the network before the transform waits
+QUEUE_SIZE = 16
+# Bytes read from the spool per write when it is sent again
+BLOCK_SIZE = 65536
+# Marks the end of the transform's output in the queue
+DONE = None
+
+
+class UploadError(Exception):
+    pass
+
+
+class LengthRequired(UploadError):
+    pass
+
+
+# The transform stopped with an error, the upload is abandoned unfinished
+class TransformError(Exception):
+    pass
+
+
+# rr_connect err 1, sending again will not help
+class WrongPassword(UploadError):
+    pass
+
+
+# Reads an HTTP reply, the Duet answers with a small JSON object
+async def read_reply(reader):
+    status = await reader.readline()
+    if not status:
+        raise UploadError('connection closed without a reply')
+    code = int(status.split()[1])
+    length = None
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length is not None else await reader.read()
+    if code == 411:
+        raise LengthRequired('the board needs the length up front')
+    if code != 200:
+        raise UploadError('HTTP %d' % code)
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        return {}
+
+
+# Output of the transform with everything taken from the queue kept on disk,
+# so a failed upload can be sent again without transforming again
+class Spool:
+    def __init__(self, queue):
+        self.queue = queue
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.crc = 0
+        self.finished = False
+
+    # Next piece of output, None once the transform is done
+    # A transform that failed raises its error here
+    async def next(self):
+        if self.finished:
+            return None
+        piece = await self.queue.get()
+        if piece is DONE or isinstance(piece, BaseException):
+            self.finished = True
+            if piece is not DONE:
+                raise TransformError('%s: %s' % (type(piece).__name__, piece)) from piece
+            return None
+        self.file.write(piece)
+        self.size += len(piece)
+        self.crc = binascii.crc32(piece, self.crc)
+        return piece
+
+    # Takes the rest of the output, which also lets the transform finish
+    async def finish(self):
+        while await self.next() is not None:
+            pass
+
+    def blocks(self):
+        self.file.seek(0)
+        while True:
+            block = self.file.read(BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        self.file.close()
+
+
+# The parts of the Duet HTTP interface an upload needs
+# Every request uses its own connection, as the board's web server prefers
+class Duet:
+    def __init__(self, url, password='', timeout=30.0):
+        parts = urllib.parse.urlsplit(url if '://' in url else 'http://' + url)
+        self.host = parts.hostname
+        self.ssl = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.password = password
+        self.timeout = timeout
+        self.session_key = None
+
+    async def connect(self):
+        query = urllib.parse.urlencode({'password': self.password, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        reply = await self.request('GET', '/rr_connect?' + query)
+        if reply.get('err') == 1:
+            raise WrongPassword('the board refused the password')
+        if reply.get('err'):
+            raise UploadError('rr_connect refused, err %s' % reply['err'])
+        self.session_key = reply.get('sessionKey')
+
+    async def disconnect(self):
+        try:
+            await self.request('GET', '/rr_disconnect')
+        except (OSError, asyncio.TimeoutError, UploadError):
+            pass
+
+    # Streams the spool's pieces as they come, awaiting the network after
+    # each one so a slow board slows the queue down
+    async def upload_stream(self, name, spool):
+        async def body(writer):
+            while True:
+                piece = await spool.next()
+                if piece is None:
+                    break
+                writer.write(b'%x\r\n' % len(piece) + piece + b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        return await self.upload(name, body, ['Transfer-Encoding: chunked'])
+
+    # Sends a finished spool with its length and CRC32
+    async def upload_spool(self, name, spool):
+        async def body(writer):
+            for block in spool.blocks():
+                writer.write(block)
+                await writer.drain()
+        return await self.upload(name, body, ['Content-Length: %d' % spool.size], spool.crc)
+
+    async def upload(self, name, body, headers, crc=None):
+        query = {'name': name, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if crc is not None:
+            query['crc32'] = '%08x' % crc
+        reply = await self.request('POST', '/rr_upload?' + urllib.parse.urlencode(query), headers, body)
+        if reply.get('err'):
+            raise UploadError('rr_upload failed, err %s' % reply['err'])
+        return reply
+
+    async def request(self, method, target, headers=(), body=None):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), self.timeout)
+        try:
+            lines = ['%s %s HTTP/1.1' % (method, target), 'Host: ' + self.host, 'Connection: close']
+            if self.session_key is not None:
+                lines.append('X-Session-Key: %s' % self.session_key)
+            lines += list(headers)
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            if body is not None:
+                try:
+                    await body(writer)
+                    await writer.drain()
+                except OSError:
+                    await Duet.early_reply(reader)
+                    raise
+            return await asyncio.wait_for(read_reply(reader), self.timeout)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    # A board that turns a body down answers before reading it and closes,
+    # that answer explains the broken connection better than the write error
+    @staticmethod
+    async def early_reply(reader):
+        try:
+            await asyncio.wait_for(read_reply(reader), 1.0)
+        except LengthRequired:
+            raise
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError, UploadError):
+            pass
+
+
+# Runs the transform in a worker thread, every piece waits for room in the
+# queue, the number of pieces that had to wait is returned
+def produce(transform, source, settings, queue, loop):
+    waits = 0
+    try:
+        for piece in Headless.stream(transform, source, settings):
+            waits += queue.full()
+            asyncio.run_coroutine_threadsafe(queue.put(bytes(piece)), loop).result()
+        asyncio.run_coroutine_threadsafe(queue.put(DONE), loop).result()
+    except BaseException as error:  # handed to the upload, which stops with it
+        asyncio.run_coroutine_threadsafe(queue.put(error), loop).result()
+    return waits
+
+
+# Transforms source and uploads the result to the board at url as name
+# The streamed attempt is followed by up to retries attempts from the spool
+def upload(transform, source, url, name, settings, password='', retries=3, queue_size=QUEUE_SIZE,
+           timeout=30.0, delay=1.0, report=None):
+    return asyncio.run(upload_async(transform, source, url, name, settings, password, retries, queue_size,
+                                    timeout, delay, report))
+
+
+async def upload_async(transform, source, url, name, settings, password='', retries=3, queue_size=QUEUE_SIZE,
+                       timeout=30.0, delay=1.0, report=None):
+    core = Headless.load_module('CoreLibrary')
+    report = report or core.Instrumentation.disabled()
+    report.start()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    spool = Spool(queue)
+    duet = Duet(url, password, timeout)
+    producer = loop.run_in_executor(None, produce, transform, source, settings, queue, loop)
+    attempts = 0
+    streamed = False
+    try:
+        with report.phase('upload'):
+            try:
+                attempts += 1
+                await duet.connect()
+                await duet.upload_stream(name, spool)
+                streamed = True
+            except WrongPassword:
+                raise
+            except (OSError, asyncio.TimeoutError, UploadError) as error:
+                await spool.finish()
+                for retry in range(retries):
+                    if not isinstance(error, LengthRequired):
+                        await asyncio.sleep(delay * 2 ** retry)
+                    attempts += 1
+                    try:
+                        await duet.connect()
+                        await duet.upload_spool(name, spool)
+                        break
+                    except WrongPassword:
+                        raise
+                    except (OSError, asyncio.TimeoutError, UploadError) as failed:
+                        error = failed
+                else:
+                    raise UploadError('upload failed after %d attempts: %s' % (attempts, error))
+    finally:
+        await spool.finish()  # never leaves the transform waiting on a full queue
+        waits = await producer
+        await duet.disconnect()
+        spool.close()
+        report.count('bytes_sent', spool.size)
+        report.count('attempts', attempts)
+        report.count('queue_waits', waits)
+        report.set('streamed', streamed)
+        report.set('crc32', '%08x' % spool.crc)
+        report.stop()
+    return {'name': name, 'bytes': spool.size, 'crc32': '%08x' % spool.crc, 'attempts': attempts, 'streamed': streamed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Melt, ColorShift or Miso and stream the result to a Duet board.')
+    parser.add_argument('transform', choices=Headless.STREAMS)
+    parser.add_argument('input', help='gcode file to process')
+    parser.add_argument('url', help='address of the board, http://duet.local')
+    parser.add_argument('--name', help='path on the board, 0:/gcodes/<input name> by default')
+    parser.add_argument('--password', default='', help='board password, if one is set with M551')
+    parser.add_argument('--settings', help='JSON file of settings')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='override a single setting')
+    parser.add_argument('--retries', type=int, default=3, help='times a failed upload is sent again from the spool')
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE, help='pieces of output allowed to wait for the network')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait on the board')
+    parser.add_argument('--report', metavar='JSON', help='write the timings and counters of the upload to this file')
+    args = parser.parse_args(argv)
+
+    name = args.name or '0:/gcodes/' + os.path.basename(args.input)
+    report = Headless.load_module('CoreLibrary').Instrumentation(memory=False) if args.report else None
+    try:
+        result = upload(args.transform, args.input, args.url, name, Headless.read_settings(args.settings, args.set),
+                        args.password, max(0, args.retries), max(1, args.queue), args.timeout, report=report)
+    except UploadError as error:
+        print('Upload failed: %s' % error, file=sys.stderr)
+        return 1
+    except TransformError as error:
+        print('Transform failed, nothing was uploaded: %s' % error, file=sys.stderr)
+        return 1
+    finally:
+        if report is not None:
+            report.write(args.report)
+    print('Uploaded %(bytes)d bytes to %(name)s, crc32 %(crc32)s, %(attempts)d attempt(s)' % result +
+          ('' if result['streamed'] else ', sent again from the spool'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
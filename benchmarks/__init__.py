@@ -0,0 +1,11 @@
+################################################################################
+#
+# MELT Benchmarks
+#
+# Synthetic Cura-shaped gcode and timings for Melt, ColorShift and Miso.
+# See runner.py for usage.
+#
+################################################################################
+
+from .generator import count_lines, generate
+from .runner import compare, main, run
@@ -0,0 +1,171 @@
+################################################################################
+#
+# MELT Benchmark Generator
+#
+# Builds synthetic gcode shaped like Cura's post processing data: a header
+# chunk, the start gcode ending in ;LAYER_COUNT:, one chunk per layer and the
+# end gcode. Each layer walks a few perimeters and a zig-zag infill so the
+# line mix (G0/G1, ;TYPE: comments, E words) resembles a sliced part.
+#
+# Usage:
+#   data = generate(layers=300, lines_per_layer=300)
+#   data = generate(tools=2, tool_change_every=5)   # T0/T1 swaps
+#   data = generate(relative_e=True, relative_z=True)  # M83 and G91 Z moves
+#   data = generate(vase=True)                      # spiralized outer wall
+#
+################################################################################
+
+import math
+import random
+
+HEADER = """;FLAVOR:RepRap
+;TIME:{time}
+;Filament used: {filament:.5f}m
+;Layer height: {height}
+;Generated with Cura_SteamEngine 4.13.1
+"""
+
+START = """M140 S60
+M105
+M190 S60
+M104 S210
+M105
+M109 S210
+{extrusion}
+G28 ;Home
+G92 E0
+G1 Z2.0 F3000
+G1 X0.1 Y20 Z0.3 F5000.0
+G1 X0.1 Y200.0 Z0.3 F1500.0 E15
+G92 E0
+;LAYER_COUNT:{layers}
+"""
+
+END = """G91 ;Relative positioning
+G1 E-2 F2700
+G1 E-2 Z0.2 F2400
+G1 X5 Y5 F3000
+G1 Z10
+G90 ;Absolute positioning
+M106 S0
+M104 S0
+M140 S0
+M84 X Y E
+M82 ;absolute extrusion mode
+M104 S0
+;End of Gcode
+"""
+
+# Extrusion per mm of travel for a 0.4mm line at the given layer height
+def extrusion_rate(height):
+    return 0.4 * height / (math.pi * 1.75 ** 2 / 4)
+
+
+def count_lines(data):
+    return sum(chunk.count("\n") for chunk in data)
+
+
+class Generator:
+    def __init__(self, layers, lines_per_layer, tools, tool_change_every, relative_e, relative_z, vase, layer_height, seed):
+        self.layers = layers
+        self.lines_per_layer = max(8, lines_per_layer)
+        self.tools = max(1, tools)
+        self.tool_change_every = tool_change_every
+        self.relative_e = relative_e
+        self.relative_z = relative_z
+        self.vase = vase
+        self.height = layer_height
+        self.rate = extrusion_rate(layer_height)
+        self.random = random.Random(seed)
+        self.e = 0.0
+        self.used = 0.0
+        self.x = 100.0
+        self.y = 100.0
+        self.z = 0.0
+
+    def extrude(self, x, y, out, z=None):
+        length = math.hypot(x - self.x, y - self.y)
+        amount = length * self.rate
+        self.x, self.y = x, y
+        self.used += amount
+        if self.relative_e:
+            e = amount
+        else:
+            self.e += amount
+            e = self.e
+        if z is None:
+            out.append("G1 X%.3f Y%.3f E%.5f" % (x, y, e))
+        else:
+            out.append("G1 X%.3f Y%.3f Z%.3f E%.5f" % (x, y, z, e))
+
+    def travel(self, x, y, out):
+        self.x, self.y = x, y
+        out.append("G0 F7200 X%.3f Y%.3f" % (x, y))
+
+    def move_z(self, z, out):
+        if self.relative_z:
+            out += ["G91", "G0 Z%.3f" % (z - self.z), "G90"]
+        else:
+            out.append("G0 F7200 X%.3f Y%.3f Z%.3f" % (self.x, self.y, z))
+        self.z = z
+
+    def perimeter(self, radius, points, out, rise=0.0):
+        jitter = self.random.uniform(-0.05, 0.05)
+        start = self.z
+        for i in range(points + 1):
+            angle = 2 * math.pi * i / points
+            x = 100 + (radius + jitter) * math.cos(angle)
+            y = 100 + (radius + jitter) * math.sin(angle)
+            if i == 0 and rise:  # a spiral carries on from the last layer
+                self.x, self.y = x, y
+            elif i == 0:
+                self.travel(x, y, out)
+            elif rise:
+                self.z = start + rise * i / points
+                self.extrude(x, y, out, self.z)
+            else:
+                self.extrude(x, y, out)
+
+    def infill(self, radius, lines, out):
+        step = 2 * radius / max(1, lines)
+        direction = 1 if self.random.random() < 0.5 else -1
+        self.travel(100 - radius, 100 - radius, out)
+        for i in range(lines):
+            x = 100 - radius + step * i
+            y = 100 + direction * radius
+            direction = -direction
+            self.extrude(x, y, out)
+
+    def layer(self, number):
+        out = [";LAYER:%d" % number, "M107" if number == 0 else "M106 S255"]
+        if self.tools > 1 and self.tool_change_every and number % self.tool_change_every == 0:
+            out.append("T%d" % (number // self.tool_change_every % self.tools))
+        spiral = self.vase and number >= 3
+        if not spiral:
+            self.move_z(round(self.height * (number + 1), 3), out)
+        budget = self.lines_per_layer - len(out)
+        if spiral:
+            out.append(";TYPE:WALL-OUTER")
+            self.perimeter(20.0, budget - 1, out, rise=self.height)
+        else:
+            points = max(4, budget // 4)
+            out.append(";TYPE:WALL-OUTER")
+            self.perimeter(20.0, points, out)
+            out.append(";TYPE:WALL-INNER")
+            self.perimeter(19.6, points, out)
+            out.append(";TYPE:FILL")
+            self.infill(19.2, max(1, budget - 2 * points - 5), out)
+        out.append(";TIME_ELAPSED:%.6f" % (number * 12.5))
+        return "\n".join(out) + "\n"
+
+    def data(self):
+        extrusion = "M83 ;relative extrusion mode" if self.relative_e else "M82 ;absolute extrusion mode"
+        start = START.format(extrusion=extrusion, layers=self.layers)
+        layers = [self.layer(number) for number in range(self.layers)]
+        header = HEADER.format(time=int(self.layers * 12.5), filament=self.used / 1000, height=self.height)
+        return [header, start] + layers + [END]
+
+
+def generate(layers=300, lines_per_layer=300, tools=1, tool_change_every=0, relative_e=False,
+             relative_z=False, vase=False, layer_height=0.2, seed=0):
+    return Generator(layers, lines_per_layer, tools, tool_change_every, relative_e, relative_z, vase, layer_height, seed).data()
@@ -0,0 +1,230 @@
+################################################################################
+#
+# MELT Benchmark Runner
+#
+# Times Melt (every shift and rate modifier, planning on every run, and once
+# more reading its plan from the schedule cache), ColorShift, Miso and the
+# filament usage scan on generated gcode and reports lines per second and
+# peak memory. Results are compared with the stored baselines and anything
+# slower or larger than the threshold allows is reported as a regression.
+#
+# Usage (from the repository root):
+#   python -m benchmarks                      # run and compare with baselines.json
+#   python -m benchmarks --save               # store this run as the new baselines
+#   python -m benchmarks --filter miso --threshold 0.10
+#   python -m benchmarks --layers 100 --lines 100 --repeat 1
+#
+#   Baselines are only compared when the input size matches the one they
+#   were recorded with, and belong to the machine that recorded them.
+#
+################################################################################
+
+import argparse
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import Headless
+from .generator import count_lines, generate
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# Inputs every case can draw from, keyword arguments for generate()
+INPUTS = {
+    'standard': {},
+    'tools': {'tools': 2, 'tool_change_every': 5},
+    'relative': {'relative_e': True, 'relative_z': True},
+    'vase': {'vase': True},
+}
+
+MELT_MODIFIERS = ['normal', 'wood', 'pattern', 'random', 'lerp', 'slope', 'ellipse']
+
+
+class Case:
+    def __init__(self, name, source, setup):
+        self.name = name
+        self.source = source
+        self.setup = setup  # returns a function that transforms a copy of the data
+
+
+# Plans on every run, the warm up in measure would otherwise fill the
+# schedule cache and the timed runs would only read it back
+def melt_case(settings):
+    def setup():
+        script = Headless.load_module('Melt').Melt()
+        for key, value in dict(settings, schedule_cache=False).items():
+            script.setSettingValueByKey(key, value)
+        return lambda data: script.execute(list(data))
+    return setup
+
+
+# Runs after the first load their plan from a schedule cache in a private
+# folder that is removed on exit
+def melt_cached_case(settings):
+    def setup():
+        melt = Headless.load_module('Melt')
+        directory = tempfile.mkdtemp(prefix='melt_benchmark_')
+        atexit.register(shutil.rmtree, directory, True)
+        melt.Melt.schedule_cache = melt.ScheduleCache(directory)
+        script = melt.Melt()
+        for key, value in dict(settings, schedule_cache=True).items():
+            script.setSettingValueByKey(key, value)
+        return lambda data: script.execute(list(data))
+    return setup
+
+
+def colorshift_case():
+    script = Headless.load_module('ColorShift').ColorShift()
+    return lambda data: script.execute(list(data))
+
+
+def miso_case(zmax=None, tolerance=0, table=False, axis=None):
+    def setup():
+        Miso = Headless.load_module('CoreLibrary').Miso
+        Miso.setMixCache(tolerance=tolerance)
+        for tool in range(2):
+            Miso.setToolConfig(tool, Miso.Tool([Miso.Mix([1, 0], 0), Miso.Mix([0, 1], 1)], axis))
+        convert = Miso.fromTable if table or axis else Miso.fromGcode
+        return lambda data: convert(Miso.iterLines(data), zmax or 1)
+    return setup
+
+
+def usage_case():
+    FilamentUsage = Headless.load_module('CoreLibrary').FilamentUsage
+
+    def scan(data):
+        usage = FilamentUsage()
+        for chunk in data:
+            usage.scan(chunk)
+        return usage
+    return scan
+
+
+def cases(layers, height=0.2):
+    zmax = layers * height
+    found = [Case('melt:' + modifier, 'standard', melt_case({'e_trigger': modifier, 'change_rate': 1}))
+             for modifier in MELT_MODIFIERS]
+    found.append(Case('melt:random_rate', 'standard', melt_case({'f_trigger': 'random', 'change_rate': 1})))
+    found.append(Case('melt:cache_hit', 'standard', melt_cached_case({'e_trigger': 'wood', 'change_rate': 1})))
+    found.append(Case('colorshift', 'standard', colorshift_case))
+    found += [Case('miso:' + source, source, miso_case(zmax)) for source in INPUTS]
+    found.append(Case('miso:vase_tolerance', 'vase', miso_case(zmax, tolerance=0.01)))
+    found.append(Case('miso:table', 'tools', miso_case(zmax, table=True)))
+    found.append(Case('miso:diagonal', 'tools', miso_case(zmax, tolerance=0.01, axis=(1, 1, 0))))
+    found += [Case('usage:' + source, source, usage_case) for source in ('standard', 'relative')]
+    return found
+
+
+# Peak memory from a first run under tracemalloc, which also warms up imports
+# and caches, then the best wall time over untraced repeats
+# Short cases keep repeating until min_time has passed to steady the best time
+def measure(transform, data, repeat, min_time=0.5):
+    tracemalloc.start()
+    try:
+        transform(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeat or total < min_time:
+        started = time.perf_counter()
+        transform(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+        runs += 1
+        total += elapsed
+    return best, peak
+
+
+def run(layers=300, lines_per_layer=300, repeat=3, name_filter=None, output=sys.stdout):
+    inputs = {}
+    results = {}
+    for case in cases(layers):
+        if name_filter and name_filter not in case.name:
+            continue
+        if case.source not in inputs:
+            inputs[case.source] = generate(layers, lines_per_layer, **INPUTS[case.source])
+        data = inputs[case.source]
+        lines = count_lines(data)
+        seconds, peak = measure(case.setup(), data, repeat)
+        results[case.name] = {
+            'lines': lines,
+            'seconds': seconds,
+            'lines_per_second': lines / seconds if seconds else 0,
+            'peak_kb': peak / 1024,
+        }
+        print('%-18s %10d lines %9.4fs %12.0f lines/s %10.0f KB peak' % (
+            case.name, lines, seconds, results[case.name]['lines_per_second'], results[case.name]['peak_kb']), file=output)
+    return results
+
+
+def load_baselines(path=BASELINES):
+    if not os.path.exists(path):
+        return None
+    with open(path) as source:
+        return json.load(source)
+
+
+def save_baselines(results, size, path=BASELINES):
+    with open(path, 'w') as output:
+        json.dump({'size': size, 'results': results}, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+# A case regresses when its throughput drops or its peak memory grows by
+# more than the threshold fraction of the baseline
+def compare(results, baselines, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result['lines_per_second'] < baseline['lines_per_second'] * (1 - threshold):
+            regressions.append('%s: %.0f lines/s, baseline %.0f' % (name, result['lines_per_second'], baseline['lines_per_second']))
+        if result['peak_kb'] > baseline['peak_kb'] * (1 + threshold):
+            regressions.append('%s: %.0f KB peak, baseline %.0f' % (name, result['peak_kb'], baseline['peak_kb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark Melt, ColorShift and Miso.')
+    parser.add_argument('--layers', type=int, default=300, help='layers in the generated gcode')
+    parser.add_argument('--lines', type=int, default=300, help='lines per generated layer')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case, the best is kept')
+    parser.add_argument('--filter', help='only run cases whose name contains this text')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown or memory growth as a fraction')
+    parser.add_argument('--baselines', default=BASELINES, help='baseline file to compare with or save to')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    args = parser.parse_args(argv)
+
+    size = {'layers': args.layers, 'lines_per_layer': args.lines}
+    results = run(args.layers, args.lines, max(1, args.repeat), args.filter)
+    if args.save:
+        stored = load_baselines(args.baselines)
+        if stored and stored['size'] == size:  # keep cases this run filtered out
+            stored['results'].update(results)
+            results = stored['results']
+        save_baselines(results, size, args.baselines)
+        print('Saved baselines to ' + args.baselines)
+        return 0
+
+    baselines = load_baselines(args.baselines)
+    if baselines is None:
+        print('No baselines found, run with --save to record them')
+        return 0
+    if baselines['size'] != size:
+        print('Baselines were recorded for %(layers)d layers of %(lines_per_layer)d lines, not comparing' % baselines['size'])
+        return 0
+    regressions = compare(results, baselines['results'], args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if not regressions:
+        print('No regressions beyond %.0f%%' % (args.threshold * 100))
+    return 1 if regressions else 0
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Headless  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def core():
+    return Headless.load_module('CoreLibrary')
+
+
+@pytest.fixture(scope='session')
+def melt():
+    return Headless.load_module('Melt')
+
+
+# Melt's default settings with any overrides, the schedule cache off so
+# every run plans
+@pytest.fixture
+def melt_settings():
+    defaults = Headless.load_script('Melt', {}).read_settings()
+
+    def settings(**overrides):
+        values = dict(defaults, schedule_cache=False)
+        values.update(overrides)
+        return values
+    return settings
+
+
+# Writes generated Cura-style gcode to a file and returns its path
+@pytest.fixture
+def write_gcode(tmp_path):
+    def write(name='input.gcode', **options):
+        path = tmp_path / name
+        path.write_text(''.join(generator.generate(**options)))
+        return str(path)
+    return write
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import Batch
+
+MISO = {'tolerance': 0.05, 'mixing_volume': 30,
+        'tools': {'0': [{'mix': [1, 0], 'z': 0}, {'mix': [0, 1], 'z': 1}]}}
+
+
+# A worker that ran a job with its own Miso settings converts the next job
+# like a fresh process would
+def test_miso_jobs_do_not_share_settings(write_gcode, tmp_path):
+    pytest.importorskip('numpy')  # mixing_volume converts through MoveTable
+    sidecar = write_gcode('sidecar.gcode', layers=20, lines_per_layer=20)
+    with open(str(tmp_path / 'sidecar.json'), 'w') as output:
+        json.dump(MISO, output)
+    plain = write_gcode('plain.gcode', layers=20, lines_per_layer=20, seed=1)
+    (tmp_path / 'shared').mkdir()
+    (tmp_path / 'solo').mkdir()
+
+    report = Batch.run_batch('miso', [sidecar, plain], str(tmp_path / 'shared'), {}, workers=1)
+    solo = Batch.run_batch('miso', [plain], str(tmp_path / 'solo'), {}, workers=1)
+
+    assert [job['status'] for job in report.jobs + solo.jobs] == ['done'] * 3
+    with open(str(tmp_path / 'shared' / 'plain.gcode')) as shared, open(str(tmp_path / 'solo' / 'plain.gcode')) as alone:
+        assert shared.read() == alone.read()
+
+
+def test_marker_after_a_large_thumbnail(tmp_path):
+    path = tmp_path / 'thumbnail.gcode'
+    thumbnail = ''.join('; %s\n' % ('A' * 76) for _ in range(2000))  # about 156 KB
+    path.write_text(';FLAVOR:RepRap\n; thumbnail begin\n' + thumbnail + '; thumbnail end\n;Modified:1\n;LAYER:0\nG1 X1 E1\n')
+    assert Batch.is_modified(str(path))
+    path.write_text(';FLAVOR:RepRap\n;LAYER:0\nG1 X1 E1\n;Modified:1\n')
+    assert not Batch.is_modified(str(path))
+
+
+# A file listed but removed before it is looked at is left out of the poll
+def test_watch_skips_files_that_vanish(write_gcode, tmp_path, monkeypatch):
+    spool = tmp_path / 'spool'
+    spool.mkdir()
+    write_gcode('spool/job.gcode', layers=5, lines_per_layer=5)
+    (tmp_path / 'done').mkdir()
+    listdir = Batch.os.listdir
+    monkeypatch.setattr(Batch.os, 'listdir', lambda path: listdir(path) + ['gone.gcode'])
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 2:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(Batch.time, 'sleep', sleep)
+
+    report = Batch.watch('colorshift', str(spool), str(tmp_path / 'done'), {}, workers=1, interval=0)
+    assert [(job['input'], job['status']) for job in report.jobs] == [(str(spool / 'job.gcode'), 'done')]
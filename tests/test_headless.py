@@ -0,0 +1,65 @@
+import multiprocessing
+
+import pytest
+
+import Headless
+
+SETTINGS = {'melt': {'schedule_cache': False}, 'colorshift': {}}
+
+
+@pytest.mark.parametrize('transform', sorted(SETTINGS))
+def test_report_covers_transform_and_write(core, write_gcode, tmp_path, transform):
+    report = core.Instrumentation(memory=False)
+    Headless.run(transform, write_gcode(layers=30, lines_per_layer=30), str(tmp_path / 'output.gcode'),
+                 SETTINGS[transform], report)
+
+    phases = report.phases
+    assert {'parse', 'emit', 'write', 'total'} <= set(phases)
+    assert phases['total'] >= sum(seconds for name, seconds in phases.items() if name != 'total')
+    assert report.counters['m567_emitted'] > 0
+    assert report.counters['lines_scanned'] > 0
+    assert report.values['total_layers'] == 30
+
+
+def test_nested_start_and_stop_time_the_outer_pair(core):
+    report = core.Instrumentation(memory=False)
+    report.start()
+    report.start()
+    report.stop()
+    assert 'total' not in report.phases
+    report.stop()
+    assert list(report.phases) == ['total']
+
+
+# The generated end gcode lifts the head with G91 then G1 Z10, relative_z
+# layers also rise from the 0.3 of the purge line
+@pytest.mark.parametrize('options,zmax', [({}, 4.0), ({'relative_z': True}, 4.3), ({'vase': True}, 4.0)])
+def test_zmax_ignores_the_relative_end_gcode(core, write_gcode, options, zmax):
+    chunks = Headless.LayerChunks(write_gcode(layers=20, lines_per_layer=20, **options))
+    try:
+        assert Headless.find_zmax(core.Miso, chunks) == pytest.approx(zmax)
+    finally:
+        chunks.close()
+
+
+def test_zmax_reads_the_cura_header(core, tmp_path):
+    path = tmp_path / 'input.gcode'
+    path.write_text(';FLAVOR:Marlin\n;MAXZ:12.6\n;LAYER:0\nG1 X1 Y1 Z0.3 E1\n')
+    chunks = Headless.LayerChunks(str(path))
+    try:
+        assert Headless.find_zmax(core.Miso, chunks) == 12.6
+    finally:
+        chunks.close()
+
+
+# Spawned workers start without the package Melt and ColorShift are loaded
+# into, the parallel Miso has to be importable on its own
+def test_parallel_miso_runs_in_spawned_workers(write_gcode):
+    settings = {'workers': 2, 'tools': {'0': [{'mix': [1, 0], 'z': 0}, {'mix': [0, 1], 'z': 1}]}}
+    Miso = Headless.load_miso(settings)
+    Headless.configure_miso(Miso, settings)
+    with open(write_gcode(layers=20, lines_per_layer=20)) as source:
+        lines = source.read().splitlines()
+    spawned = Miso.fromGcodeParallel(lines, 4.0, 2, 300, multiprocessing.get_context('spawn'))
+    assert spawned.count('M567') > 1
+    assert spawned == Miso.fromGcode(lines, 4.0)
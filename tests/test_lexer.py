@@ -0,0 +1,26 @@
+import pytest
+
+
+@pytest.mark.parametrize('line', ['G1 X10 Y5 E0.4', 'G1X10Y5E0.4', 'g1x10y5e0.4 ;infill', 'G01X10Y5E.4'])
+def test_extruding_move(core, line):
+    command = core.Miso.Lexer.parse(line)
+    assert command.code == 'G1'
+    assert command.params == {'X': 10.0, 'Y': 5.0, 'E': 0.4}
+    assert command.value('E') == 0.4
+    assert core.Miso.Gcode.isExtrude(line)
+
+
+def test_compact_words(core):
+    assert core.Miso.Gcode.updateZ('G0Z0.4', 0, False) == 0.4
+    assert core.Miso.Gcode.updateZ('G0Z.2F3000', 0.4, True) == pytest.approx(0.6)
+    assert not core.Miso.Gcode.isExtrude('G0X10Y5F3000')
+    assert core.Miso.Lexer.parse('M104S200').code == 'M104'
+    assert core.Miso.Lexer.parse('M567P1E0.25:0.75').body == 'M567 P1 E0.25:0.75'
+    assert core.Miso.Gcode.updateTool('T1', 0) == 1
+
+
+def test_comments_and_blank_lines(core):
+    assert core.Miso.Lexer.parse(';LAYER:3') is None
+    assert core.Miso.Lexer.parse('   ;G1X10E1') is None
+    assert core.Miso.Lexer.parse('') is None
+    assert not core.Miso.Gcode.isExtrude('G1 X10 ;E1')
@@ -0,0 +1,59 @@
+import itertools
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+MODIFIERS = ('normal', 'wood', 'pattern', 'random', 'lerp', 'slope', 'ellipse')
+
+
+def scalar_strings(melt, schedule):
+    return [melt.format_ratios(schedule.mix(change)) for change in range(len(schedule))]
+
+
+@pytest.mark.parametrize('modifier,qty_extruders,rate_modifier,change_rate,direction', list(itertools.product(
+    MODIFIERS, ('2', '3', '4'), ('normal', 'random'), (1, 3, 7), ('normal', 'reversed'))))
+def test_batch_plan_matches_scalar(melt, melt_settings, monkeypatch, modifier, qty_extruders, rate_modifier,
+                                   change_rate, direction):
+    settings = melt_settings(e_trigger=modifier, qty_extruders=qty_extruders, f_trigger=rate_modifier,
+                             change_rate=change_rate, b_trigger=direction, random_seed=11, flow_min=2, flow_adjust=-3)
+    batches = []
+    plan_ratios_batch = melt.plan_ratios_batch
+    monkeypatch.setattr(melt, 'plan_ratios_batch', lambda *args: batches.append(args) or plan_ratios_batch(*args))
+
+    batch = melt.plan_schedule(settings, 180, vectorize=True)
+    scalar = melt.plan_schedule(settings, 180, vectorize=False)
+
+    assert batches, 'the batch modifiers were not used'
+    assert batch.layers == scalar.layers
+    assert batch.ratios == scalar.ratios
+    assert melt.format_schedule(batch) == scalar_strings(melt, scalar)
+    assert batch.initial == scalar.initial
+    assert batch.final == scalar.final
+    assert batch.end_layer == scalar.end_layer
+
+
+def test_linear_plans_match_scalar(melt, melt_settings):
+    # c_trigger 0 spreads the changes over every extruder instead of one fewer
+    settings = melt_settings(qty_extruders='3', c_trigger='0', change_rate=1)
+    batch = melt.plan_schedule(settings, 60, vectorize=True)
+    scalar = melt.plan_schedule(settings, 60, vectorize=False)
+    assert batch.layers == scalar.layers
+    assert batch.ratios == scalar.ratios
+
+
+@pytest.mark.parametrize('value', [0.0, -0.0, -1e-9, 1e-9, 0.0005, 0.0015, 0.9995, 1.0, 1.0004, 1.2, -0.25])
+def test_ratio_matrix_formats_like_ratios(melt, core, value):
+    matrix = numpy.array([[value, 1 - value]])
+    assert melt.format_ratio_matrix(matrix).tolist() == [core.MixFormat.ratios([value, 1 - value])]
+
+
+def test_negative_zero_formats_as_zero(melt, core):
+    assert melt.format_ratio_matrix(numpy.array([[-0.0, 1.0]])).tolist() == [['0.000', '1.000']]
+    assert core.MixFormat.ratios([-0.0]) == ['0.000']
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_matrix_is_refused(melt, value):
+    with pytest.raises(ValueError, match='Mix ratio must be a finite number, not %s' % value):
+        melt.format_ratio_matrix(numpy.array([[0.5, 0.5], [0.5, value]]))
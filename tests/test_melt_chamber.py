@@ -0,0 +1,48 @@
+import Headless
+from benchmarks.generator import generate
+
+PURGE = 'G1 X0.1 Y200.0 Z0.3 F1500.0 E15'
+SETUP = ('M563 ', 'G10 ', 'M568 ')
+
+
+def melt(data, **settings):
+    script = Headless.load_script('Melt', dict(dict(schedule_cache=False, enable_initial=True), **settings))
+    return ''.join(script.execute(data)).split('\n')
+
+
+def first(lines, prefix):
+    return next(number for number, line in enumerate(lines) if line.startswith(prefix))
+
+
+def assert_mixes_follow_setup(lines):
+    mixes = [number for number, line in enumerate(lines) if line.startswith('M567')]
+    setup = max(number for number, line in enumerate(lines) if line.startswith(SETUP))
+    assert mixes
+    assert min(mixes) > first(lines, PURGE)
+    assert min(mixes) > first(lines, ';LAYER_COUNT:')
+    assert min(mixes) > setup
+
+
+def test_early_mixes_stay_after_the_setup_block():
+    lines = melt(generate(layers=20, lines_per_layer=30), mixing_volume=20)
+    assert_mixes_follow_setup(lines)
+
+
+def test_early_mixes_stay_after_an_earlier_runs_setup():
+    data = generate(layers=20, lines_per_layer=30)
+    once = melt(data, mixing_volume=20)
+    twice = melt(['\n'.join(once)], mixing_volume=20)
+    assert_mixes_follow_setup(twice)
+
+
+def test_clamped_mix_is_counted_and_later_mixes_still_move(core):
+    report = core.Instrumentation(memory=False)
+    script = Headless.load_script('Melt', {'schedule_cache': False, 'enable_initial': True, 'mixing_volume': 60,
+                                           'change_rate': 1}, report)
+    lines = ''.join(script.execute(generate(layers=20, lines_per_layer=30))).split('\n')
+    assert_mixes_follow_setup(lines)
+    assert report.counters['m567_clamped'] >= 1
+    assert report.counters['m567_shifted'] > report.counters['m567_clamped']
+    # The mix for layer 2 is written while layer 1 prints
+    mixes = [number for number, line in enumerate(lines) if line.startswith('M567')]
+    assert any(first(lines, ';LAYER:1') < number < first(lines, ';LAYER:2') for number in mixes)
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+
+def segments(melt, melt_settings, *values):
+    return melt.parse_segments(melt_settings(segments=json.dumps(list(values))))
+
+
+def test_values_are_converted_to_their_setting_types(melt, melt_settings):
+    parsed = segments(melt, melt_settings, {'change_rate': '10', 'percent_change_end': '50.5', 'qty_extruders': 3,
+                                            'b_trigger': 'reversed', 'reapply': True, 'pattern': [1, 0.5],
+                                            'start_mix': '0, 1', 'end_mix': [1, 0]})
+    assert parsed == [{'change_rate': 10, 'percent_change_end': 50.5, 'qty_extruders': '3', 'b_trigger': 'reversed',
+                       'reapply': True, 'pattern': '1.0,0.5', 'start_mix': '0.0,1.0', 'end_mix': '1.0,0.0'}]
+
+
+@pytest.mark.parametrize('segment,message', [
+    ({'change_rate': 'fast'}, 'change_rate must be a number, not "fast"'),
+    ({'change_rate': [4]}, 'change_rate must be a number'),
+    ({'percent_change_end': None}, 'percent_change_end must be a number'),
+    ({'percent_change_end': True}, 'percent_change_end must be a number'),
+    ({'percent_change_end': 'nan'}, 'percent_change_end must be a finite number'),
+    ({'reapply': 'yes'}, 'reapply must be true or false'),
+    ({'e_trigger': 'zigzag'}, 'e_trigger must be one of normal, wood'),
+    ({'qty_extruders': 5}, 'qty_extruders must be one of 2, 3, 4'),
+    ({'initial_a': 3}, 'initial_a must be a string'),
+    ({'start_mix': '1,x'}, 'start_mix must be a number, not "x"'),
+])
+def test_bad_values_name_the_segment(melt, melt_settings, segment, message):
+    with pytest.raises(ValueError) as error:
+        segments(melt, melt_settings, {'percent_change_end': 50}, segment)
+    assert str(error.value).startswith('Gradient segment 2 ' + json.dumps(segment))
+    assert message in str(error.value)
+
+
+def test_unknown_keys_are_rejected(melt, melt_settings):
+    with pytest.raises(ValueError, match='Unknown gradient segment setting: speed'):
+        segments(melt, melt_settings, {'speed': 1})
+
+
+def changes(schedule):
+    return [(schedule.layers[change], schedule.mix(change)) for change in range(len(schedule))]
+
+
+# String values plan the same as the typed values of each segment planned on
+# its own, one after the other
+def test_converted_segments_plan(melt, melt_settings):
+    settings = melt_settings(segments=json.dumps([{'percent_change_end': '50', 'change_rate': '5'},
+                                                  {'percent_change_start': 50, 'start_mix': [0, 1], 'end_mix': '1,0'}]))
+    schedule = melt.plan_segments(settings, 100)
+
+    first = melt.plan_schedule(dict(settings, percent_change_end=50, change_rate=5), 100)
+    second = melt.plan_blend(dict(settings, percent_change_start=50, start_mix='0.0,1.0', end_mix='1.0,0.0'), 100)
+    assert len(first) > 1 and len(second) > 1
+    assert max(first.layers) <= first.end_layer <= min(second.layers)
+    assert changes(schedule) == changes(first) + [(first.end_layer, first.final)] + changes(second)
+    assert schedule.initial == first.initial
+    assert schedule.final == second.final
+    assert schedule.end_layer == second.end_layer
+    assert schedule.report['segments'] == 2
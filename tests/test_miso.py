@@ -0,0 +1,44 @@
+import pytest
+
+# Tool 0 always mixes 1:0 and tool 1 always 0:1
+@pytest.fixture
+def Miso(core, monkeypatch):
+    monkeypatch.setattr(core.Miso, '_toolConfigs', {})
+    for tool in (0, 1):
+        core.Miso.setToolConfig(tool, core.Miso.Tool([core.Miso.Mix([1 - tool, tool], 0)]))
+    return core.Miso
+
+
+def mixes(lines, convert):
+    return [line for line in convert(lines, 10.0).splitlines() if line.startswith('M567')]
+
+
+CONVERSIONS = ['fromGcode', 'fromTable', 'fromGcodeParallel']
+
+
+def conversion(Miso, name):
+    if name == 'fromTable':
+        pytest.importorskip('numpy')
+    if name == 'fromGcodeParallel':
+        return lambda lines, zmax: Miso.fromGcodeParallel(lines, zmax, workers=2, chunkSize=3)
+    return getattr(Miso, name)
+
+
+# Without a barrier the same mix for the same tool is written once
+@pytest.mark.parametrize('name', CONVERSIONS)
+def test_repeated_mix_is_left_out(Miso, name):
+    lines = ['G1 Z1 E1', 'M117 hello', 'G1 Z2 E1', 'G1 Z3 E1']
+    assert mixes(lines, conversion(Miso, name)) == ['M567 P0 E1.000:0.000']
+
+
+@pytest.mark.parametrize('name', CONVERSIONS)
+def test_tool_change_writes_the_mix_again(Miso, name):
+    lines = ['G1 Z1 E1', 'T1', 'G1 X1 E1', 'T0', 'G1 X2 E1', 'T1', 'G1 X3 E1']
+    assert mixes(lines, conversion(Miso, name)) == ['M567 P0 E1.000:0.000', 'M567 P1 E0.000:1.000',
+                                                          'M567 P0 E1.000:0.000', 'M567 P1 E0.000:1.000']
+
+
+@pytest.mark.parametrize('name', CONVERSIONS)
+def test_redefined_tool_gets_its_mix_again(Miso, name):
+    lines = ['G1 Z1 E1', 'M563 P0 D0:1 H1', 'G1 Z2 E1', 'M563 P1 D0:1', 'G1 Z3 E1']
+    assert mixes(lines, conversion(Miso, name)) == ['M567 P0 E1.000:0.000', 'M567 P0 E1.000:0.000']
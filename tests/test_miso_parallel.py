@@ -0,0 +1,51 @@
+from concurrent.futures import Future
+
+
+def gcode(layers):
+    lines = ['G90', 'T1']
+    for layer in range(layers):
+        lines.append(';LAYER:%d' % layer)
+        lines.append('G0 Z%.1f' % (0.2 * (layer + 1)))
+        lines += ['G1 X%d Y%d E0.1' % (step, layer) for step in range(5)]
+    return lines
+
+
+def test_parallel_matches_serial(core, monkeypatch):
+    Miso = core.Miso
+    monkeypatch.setattr(Miso, '_toolConfigs', {})
+    Miso.setToolConfig(1, Miso.Tool([Miso.Mix([1, 0], 0), Miso.Mix([0, 1], 1)]))
+    lines = gcode(40)
+    assert Miso.fromGcodeParallel(lines, 8.0, workers=2, chunkSize=23) == Miso.fromGcode(lines, 8.0)
+
+
+# Runs every job as it is submitted, the test counts the ones in flight
+class Pool:
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, function, job):
+        self.submitted += 1
+        future = Future()
+        future.set_result(job)
+        return future
+
+
+def test_in_order_keeps_a_bounded_window(core):
+    pool = Pool()
+    results = []
+    most = 0
+    for result in core.Miso._inOrder(pool, iter(range(50)), 4):
+        most = max(most, pool.submitted - len(results))
+        results.append(result)
+    assert results == list(range(50))
+    assert most == 4
+
+
+def test_parallel_reads_compact_gcode(core, monkeypatch):
+    Miso = core.Miso
+    monkeypatch.setattr(Miso, '_toolConfigs', {})
+    Miso.setToolConfig(1, Miso.Tool([Miso.Mix([1, 0], 0), Miso.Mix([0, 1], 1)]))
+    lines = [line.replace(' ', '') for line in gcode(40)]
+    serial = Miso.fromGcode(lines, 8.0)
+    assert serial.count('M567') == 40
+    assert Miso.fromGcodeParallel(lines, 8.0, workers=2, chunkSize=23) == serial
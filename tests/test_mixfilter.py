@@ -0,0 +1,63 @@
+def filtered(core, gcode):
+    data = [gcode]
+    removed = core.MixFilter().apply(data)
+    return data[0], removed
+
+
+def test_repeated_mix_is_removed(core):
+    gcode, removed = filtered(core, 'M567 P0 E0.5:0.5\nG1 X1 E1\nM567 P0 E0.5:0.5\nG1 X2 E2\n')
+    assert removed == 1
+    assert gcode == 'M567 P0 E0.5:0.5\nG1 X1 E1\nG1 X2 E2\n'
+
+
+def test_mix_after_tool_redefinition_is_kept(core):
+    source = 'M567 P0 E0.5:0.5\nG1 X1 E1\nM563 P0 D0:1 H1\nM567 P0 E0.5:0.5\nG1 X2 E2\n'
+    gcode, removed = filtered(core, source)
+    assert removed == 0
+    assert gcode == source
+
+
+def test_redefinition_without_tool_forgets_every_mix(core):
+    source = 'M567 P0 E1:0\nM567 P1 E0:1\nG1 X1 E1\nM563 D0:1 H1\nM567 P0 E1:0\nM567 P1 E0:1\nG1 X2 E2\n'
+    gcode, removed = filtered(core, source)
+    assert removed == 0
+    assert gcode == source
+
+
+def test_redefinition_of_another_tool_keeps_the_mix(core):
+    gcode, removed = filtered(core, 'M567 P0 E1:0\nG1 X1 E1\nM563 P1 D0:1\nM567 P0 E1:0\nG1 X2 E2\n')
+    assert removed == 1
+    assert gcode == 'M567 P0 E1:0\nG1 X1 E1\nM563 P1 D0:1\nG1 X2 E2\n'
+
+
+def test_redefinition_in_a_chunk_without_mixes(core):
+    data = ['M567 P0 E1:0\nG1 X1 E1\n', 'M563 P0 D0:1\nG1 X2 E2\n', 'M567 P0 E1:0\nG1 X3 E3\n']
+    assert core.MixFilter().apply(data) == 0
+    assert data[2] == 'M567 P0 E1:0\nG1 X3 E3\n'
+
+
+def test_mix_after_tool_change_is_kept(core):
+    source = 'M567 P1 E0.5:0.5\nT1\nG1 X1 E1\nT0\nG1 X2 E2\nT1\nM567 P1 E0.5:0.5\nG1 X3 E3\n'
+    gcode, removed = filtered(core, source)
+    assert removed == 0
+    assert gcode == source
+
+
+def test_tool_change_ends_the_window(core):
+    # the first mix is in effect when T1 selects the tool, it is not replaced
+    source = 'M567 P1 E1:0\nT1\nM567 P1 E0:1\nG1 X1 E1\n'
+    gcode, removed = filtered(core, source)
+    assert removed == 0
+    assert gcode == source
+
+
+def test_tool_change_at_the_start_of_a_chunk(core):
+    data = ['M567 P1 E1:0\nT1\nG1 X1 E1\n', 'T1\nG1 X2 E2\n', 'M567 P1 E1:0\nG1 X3 E3\n']
+    assert core.MixFilter().apply(data) == 0
+    assert data[2] == 'M567 P1 E1:0\nG1 X3 E3\n'
+
+
+def test_change_to_another_tool_keeps_the_mix(core):
+    gcode, removed = filtered(core, 'M567 P0 E1:0\nG1 X1 E1\n  T1\nM567 P0 E1:0\nG1 X2 E2\n')
+    assert removed == 1
+    assert gcode == 'M567 P0 E1:0\nG1 X1 E1\n  T1\nG1 X2 E2\n'
@@ -0,0 +1,12 @@
+import pytest
+
+
+@pytest.mark.parametrize('value', [0.0, 0.0005, 0.25, 0.9995, 1.0, 1.2, -0.25])
+def test_ratios_format_like_format(core, value):
+    assert core.MixFormat.ratios([value]) == [format(value, '.3f')]
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_ratios_are_refused(core, value):
+    with pytest.raises(ValueError, match='Mix ratio must be a finite number, not %s' % value):
+        core.MixFormat.command([0.5, value])
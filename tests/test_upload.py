@@ -0,0 +1,88 @@
+import asyncio
+import binascii
+
+import pytest
+
+import Headless
+import Upload
+from DuetMock import DuetMock
+
+NAME = '0:/gcodes/print.gcode'
+
+
+def upload(source, mock, **options):
+    async def run():
+        async with mock:
+            result = await Upload.upload_async('melt', source, mock.url, NAME, {'schedule_cache': False},
+                                               delay=0.01, **options)
+            return result, mock.files.get(NAME)
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def source(write_gcode):
+    return write_gcode(layers=40, lines_per_layer=40)
+
+
+@pytest.fixture
+def expected(source):
+    return b''.join(Headless.stream('melt', source, {'schedule_cache': False}))
+
+
+def assert_stored(result, stored, expected):
+    assert stored == expected
+    assert result['bytes'] == len(expected)
+    assert result['crc32'] == '%08x' % binascii.crc32(expected)
+
+
+def test_streamed_upload(source, expected):
+    result, stored = upload(source, DuetMock())
+    assert_stored(result, stored, expected)
+    assert result['attempts'] == 1
+    assert result['streamed'] is True
+
+
+def test_dropped_uploads_are_sent_again_from_the_spool(source, expected):
+    mock = DuetMock(fail=2)
+    result, stored = upload(source, mock)
+    assert_stored(result, stored, expected)
+    assert result['attempts'] == 3
+    assert result['streamed'] is False
+    assert mock.requests.count(('POST', '/rr_upload')) == 3
+
+
+def test_too_many_dropped_uploads_fail(source):
+    mock = DuetMock(fail=3)
+    with pytest.raises(Upload.UploadError, match='after 3 attempts'):
+        upload(source, mock, retries=2)
+    assert mock.files == {}
+
+
+def test_board_that_needs_the_length_gets_the_spool(source, expected):
+    result, stored = upload(source, DuetMock(require_length=True))
+    assert_stored(result, stored, expected)
+    assert result['attempts'] == 2
+    assert result['streamed'] is False
+
+
+def test_slow_board_still_gets_the_stream(source, expected, core):
+    report = core.Instrumentation(memory=False)
+    result, stored = upload(source, DuetMock(read_delay=0.002), queue_size=2, report=report)
+    assert_stored(result, stored, expected)
+    assert result['attempts'] == 1
+    assert result['streamed'] is True
+    assert report.counters['bytes_sent'] == len(expected)
+
+
+def test_wrong_password_is_not_retried(source):
+    mock = DuetMock(password='secret')
+    with pytest.raises(Upload.WrongPassword):
+        upload(source, mock)
+    assert mock.requests.count(('GET', '/rr_connect')) == 1
+
+
+def test_failed_transform_stores_nothing(tmp_path):
+    mock = DuetMock()
+    with pytest.raises(Upload.TransformError):
+        upload(str(tmp_path / 'missing.gcode'), mock)
+    assert mock.files == {}